@@ -0,0 +1,161 @@
+import asyncio
+import discord
+import glob
+import os
+import random
+import re
+import subprocess
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from metrics import METRICS
+
+
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+
+
+class PCMClip(discord.AudioSource):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.started = None
+
+    def read(self):
+        if self.started is None:
+            self.started = time.monotonic()
+        frame = self.data[self.pos:self.pos + FRAME_SIZE]
+        self.pos += FRAME_SIZE
+        if 0 < len(frame) < FRAME_SIZE:
+            frame += b'\0' * (FRAME_SIZE - len(frame))
+        return frame
+
+    def is_opus(self):
+        return False
+
+
+class ClipLibrary:
+    def __init__(self, directory='res', max_bytes=64 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.variants = {}
+        self.names = {}
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        # clips are decoded in executor threads, the preload and announcements can miss the cache at the same time
+        self.lock = threading.Lock()
+        self.index()
+
+    def index(self):
+        variants = {}
+        for fn in sorted(glob.glob(os.path.join(self.directory, '*.wav'))):
+            name = os.path.basename(fn)[:-len('.wav')]
+            m = re.fullmatch(r'(.+)_(\d+)', name)
+            if m:
+                variants.setdefault(m.group(1), []).append((int(m.group(2)), fn))
+            else:
+                self.names[name] = fn
+        self.variants = {key: [fn for _, fn in sorted(opts)] for key, opts in variants.items()}
+
+    def message_clip(self, msg_value):
+        opts = self.variants.get(msg_value)
+        return random.choice(opts) if opts else None
+
+    def name_clip(self, name):
+        return self.names.get(name)
+
+    @staticmethod
+    def decode(fn):
+        res = subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', fn, '-f', 's16le', '-ar', '48000', '-ac', '2', 'pipe:1'],
+                             stdout=subprocess.PIPE, check=True)
+        return res.stdout
+
+    def get(self, fn):
+        with self.lock:
+            data = self.cache.get(fn)
+            if data is not None:
+                self.cache.move_to_end(fn)
+                return data
+        data = self.decode(fn)
+        with self.lock:
+            if fn not in self.cache:
+                self.cache[fn] = data
+                self.cache_bytes += len(data)
+            while self.cache_bytes > self.max_bytes and len(self.cache) > 1:
+                _, old = self.cache.popitem(last=False)
+                self.cache_bytes -= len(old)
+        return data
+
+    def preload(self):
+        for fn in list(self.names.values()) + [fn for opts in self.variants.values() for fn in opts]:
+            self.get(fn)
+
+    def render(self, parts):
+        """
+        Concatenates clip filenames and pauses given in seconds into a single PCM buffer.
+        """
+        res = []
+        for part in parts:
+            if isinstance(part, str):
+                res.append(self.get(part))
+            else:
+                res.append(bytes(int(part * discord.opus.Encoder.SAMPLING_RATE) * discord.opus.Encoder.SAMPLE_SIZE))
+        return b''.join(res)
+
+
+class Announcer:
+    def __init__(self, client: discord.Client, clips: ClipLibrary, idle_timeout=60.0):
+        self.client = client
+        self.clips = clips
+        self.idle_timeout = idle_timeout
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.latencies = deque(maxlen=100)
+
+    def announce(self, channel, parts):
+        self.queue.put_nowait((channel, parts, time.monotonic()))
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def connect(self, channel):
+        # one voice connection per guild, each guild has its own announcer
+        vc = channel.guild.voice_client
+        if vc is not None and vc.is_connected():
+            if vc.channel != channel:
+                await vc.move_to(channel)
+            return vc
+        vc = await channel.connect()
+        await asyncio.sleep(1)
+        return vc
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        vc = None
+        try:
+            while True:
+                try:
+                    channel, parts, queued = await asyncio.wait_for(self.queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                try:
+                    source = PCMClip(await loop.run_in_executor(None, self.clips.render, parts))
+                    if vc is None or not vc.is_connected():
+                        vc = await self.connect(channel)
+                    done = loop.create_future()
+                    vc.play(source, after=lambda err: loop.call_soon_threadsafe(done.set_result, err))
+                    await done
+                except Exception:
+                    # one broken announcement should not take the ones queued after it along
+                    METRICS.inc('action_failures_total', action='announce', reason='error')
+                    print('announcement failed:')
+                    traceback.print_exc()
+                    continue
+                if source.started is not None:
+                    self.latencies.append(source.started - queued)
+                    METRICS.observe('voice_start_latency_seconds', source.started - queued)
+                    print(f'announcement started {source.started - queued:0.2f}s after it was queued')
+        finally:
+            if vc is not None and vc.is_connected():
+                await vc.disconnect()
+            if not self.queue.empty():
+                self.task = loop.create_task(self.run())
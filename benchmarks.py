@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from clock import SYSTEM_CLOCK
+from config import Config, ConfKey
+from fakes import FakeBot, FakeChannel, FakeMember, FakeMessage
+from state import State, UserKey
+from therapy_bot import TherapyBot
+import markov
+
+
+WORDS = [f'w{i}' for i in range(5000)]
+# weights for a roughly zipfian word distribution
+WEIGHTS = [1 / (i + 1) for i in range(len(WORDS))]
+
+
+def synthetic_messages(channel, n, authors, rng):
+    members = [FakeMember(1000 + i) for i in range(authors)]
+    res = []
+    for i in range(n):
+        text = ' '.join(rng.choices(WORDS, WEIGHTS, k=rng.randint(3, 20)))
+        res.append(FakeMessage(10**6 + i, rng.choice(members), channel, text))
+    return res
+
+
+def best_of(repeat, fn, *args):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def make_config(directory, channel_ids):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config_example.json'), 'r') as f:
+        conf = json.load(f)
+    conf[ConfKey.MARKOV_CHANNELS.value] = channel_ids
+    conf[ConfKey.MARKOV_WORKERS.value] = 2
+    fn = os.path.join(directory, 'config.json')
+    with open(fn, 'w') as f:
+        json.dump(conf, f)
+    return Config(fn)
+
+
+def bench_state(results, directory, sizes, repeat):
+    for n in sizes:
+        config = make_config(directory, [])
+        fn = os.path.join(directory, f'state_{n}.json')
+        state = State(config, fn)
+        for user_id in range(n):
+            state.update_last_active(user_id)
+            state.set_user_key(user_id, UserKey.ENABLED, user_id % 2 == 0)
+        ops = min(n * 10, 10**5)
+        ids = [random.randrange(n) for _ in range(ops)]
+
+        def update_last_active():
+            for user_id in ids:
+                state.update_last_active(user_id)
+
+        def get_user_key():
+            for user_id in ids:
+                state.get_user_key(user_id, UserKey.WORK_DELAY)
+
+        def get_enabled_users():
+            for _ in state.get_enabled_users():
+                pass
+
+        results[f'state.update_last_active[{n}]'] = best_of(repeat, update_last_active) / ops
+        results[f'state.get_user_key[{n}]'] = best_of(repeat, get_user_key) / ops
+        results[f'state.get_enabled_users[{n}]'] = best_of(repeat, get_enabled_users)
+        state.close()
+        os.remove(fn)
+
+
+def bench_avatar(results, directory, repeat):
+    state = State(make_config(directory, []), os.path.join(directory, 'state_avatar.json'))
+    for user_id in range(100):
+        state.update_last_active(user_id)
+        state.set_user_key(user_id, UserKey.ENABLED, True)
+    state.set_user_key(0, UserKey.SLACKING, True)
+    bot = SimpleNamespace(partitions={None: SimpleNamespace(state=state)}, clock=SYSTEM_CLOCK, angered=0,
+                          wanted_expression=None, avatar_changed=asyncio.Event())
+    ops = 10**5
+
+    def set_avatar():
+        for _ in range(ops):
+            TherapyBot.set_avatar(bot)
+
+    results['bot.set_avatar'] = best_of(repeat, set_avatar) / ops
+    state.close()
+
+
+async def bench_markov(results, directory, n_messages, repeat):
+    rng = random.Random(0)
+    channel = FakeChannel(1)
+    channel.messages = synthetic_messages(channel, n_messages, 10, rng)
+    reply = FakeChannel(2)
+    bot = FakeBot([channel, reply])
+    m = markov.Markov(bot, make_config(directory, [channel.id]))
+    try:
+        os.makedirs('markov', exist_ok=True)
+        start = time.perf_counter()
+        await m.regenerate(FakeMessage(1, None, reply, '!markov regenerate'))
+        results[f'markov.regenerate[{n_messages}]'] = time.perf_counter() - start
+    finally:
+        m.close()
+    # sentence generation is timed in this process, without the pool's round trip
+    markov._init_worker(8, 0.7)
+    ops = 200
+
+    def make_sentence():
+        for _ in range(ops):
+            markov._make_sentence(markov.MARKOV_DIR, 'all')
+
+    results[f'markov.make_sentence[{n_messages}]'] = best_of(repeat, make_sentence) / ops
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, value in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        ratio = value / old if old else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name}: {old:.3g} -> {value:.3g} ({ratio:.2f}x){flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the bot\'s hot paths without connecting to discord.')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio counted as a regression')
+    parser.add_argument('--users', default='10,1000,100000', help='comma separated user counts')
+    parser.add_argument('--messages', type=int, default=20000, help='size of the synthetic markov corpus')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the fastest is kept')
+    args = parser.parse_args()
+
+    results = {}
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='therapy_bench_')
+    try:
+        # markov files are relative to the working directory
+        os.chdir(directory)
+        bench_state(results, directory, [int(n) for n in args.users.split(',')], args.repeat)
+        bench_avatar(results, directory, args.repeat)
+        asyncio.run(bench_markov(results, directory, args.messages, args.repeat))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+    for name, value in sorted(results.items()):
+        print(f'{name}: {value * 1e6:.2f}us')
+    report = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s): {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
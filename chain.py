@@ -0,0 +1,173 @@
+import bisect
+import mmap
+import os
+import random
+import struct
+from array import array
+from markovify.chain import BEGIN, END
+
+
+BEGIN_ID = 0
+END_ID = 1
+MAGIC = b'MKC1'
+# magic, number of states, number of transitions, state size
+HEADER = struct.Struct('<4sIII')
+VOCAB_MAGIC = b'MKV1'
+# magic, number of words
+VOCAB_HEADER = struct.Struct('<4sI')
+
+
+class Vocab:
+    def __init__(self, words=None):
+        self.words = words if words is not None else [BEGIN, END]
+        self.ids = {word: i for i, word in enumerate(self.words)}
+
+    @classmethod
+    def load(cls, filename):
+        if not os.path.exists(filename):
+            return cls()
+        with open(filename, 'r', encoding='utf-8') as f:
+            return cls(f.read().split('\n'))
+
+    def __getitem__(self, i):
+        return self.words[i]
+
+    def __len__(self):
+        return len(self.words)
+
+    def add(self, word):
+        i = self.ids.get(word)
+        if i is None:
+            i = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return i
+
+    def save(self, filename):
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.words))
+        os.replace(filename + '.tmp', filename)
+
+    def save_snapshot(self, filename):
+        data = [word.encode('utf-8') for word in self.words]
+        offsets = array('I', [0])
+        for word in data:
+            offsets.append(offsets[-1] + len(word))
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(VOCAB_HEADER.pack(VOCAB_MAGIC, len(data)))
+            f.write(offsets.tobytes())
+            f.write(b''.join(data))
+        os.replace(filename + '.tmp', filename)
+
+
+class VocabSnapshot:
+    """
+    Read-only, memory mapped vocabulary written by Vocab.save_snapshot, words are decoded on access.
+    """
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, n_words = VOCAB_HEADER.unpack_from(buf)
+        if magic != VOCAB_MAGIC:
+            raise ValueError(f'{filename} is not a vocabulary snapshot')
+        end = VOCAB_HEADER.size + 4 * (n_words + 1)
+        return cls(buf[VOCAB_HEADER.size:end].cast('I'), buf[end:])
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def check_chain(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return False
+    magic, n_states, n_edges, state_size = HEADER.unpack(header)
+    return magic == MAGIC and state_size == 2 and os.path.getsize(filename) == HEADER.size + 12 * n_states + 4 + 8 * n_edges
+
+
+class CompactChain:
+    """
+    A state size 2 markov chain over vocabulary ids, stored as CSR rows:
+    keys holds the sorted states (first id << 32 | second id), row i's followers and
+    their cumulative weights are at indptr[i]:indptr[i + 1].
+    """
+    def __init__(self, keys, indptr, followers, weights):
+        self.keys = keys
+        self.indptr = indptr
+        self.followers = followers
+        self.weights = weights
+
+    @classmethod
+    def from_markovify(cls, chain, vocab: Vocab):
+        rows = []
+        for state, followers in chain.model.items():
+            if len(state) != 2:
+                raise ValueError(f'unsupported state size {len(state)}')
+            key = vocab.ids[state[0]] << 32 | vocab.ids[state[1]]
+            rows.append((key, [(vocab.ids[word], count) for word, count in followers.items()]))
+        rows.sort()
+        keys, indptr, followers, weights = array('Q'), array('I', [0]), array('I'), array('I')
+        for key, row in rows:
+            keys.append(key)
+            total = 0
+            for word_id, count in row:
+                total += count
+                followers.append(word_id)
+                weights.append(total)
+            indptr.append(len(followers))
+        return cls(keys, indptr, followers, weights)
+
+    def save(self, filename):
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(self.keys), len(self.followers), 2))
+            for arr in (self.keys, self.indptr, self.followers, self.weights):
+                f.write(arr.tobytes())
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, n_states, n_edges, state_size = HEADER.unpack_from(buf)
+        if magic != MAGIC or state_size != 2:
+            raise ValueError(f'{filename} is not a compact chain')
+        arrays = []
+        pos = HEADER.size
+        for fmt, n in (('Q', n_states), ('I', n_states + 1), ('I', n_edges), ('I', n_edges)):
+            size = n * struct.calcsize(fmt)
+            arrays.append(buf[pos:pos + size].cast(fmt))
+            pos += size
+        return cls(*arrays)
+
+    def row(self, first, second):
+        key = first << 32 | second
+        i = bisect.bisect_left(self.keys, key)
+        return i if i < len(self.keys) and self.keys[i] == key else -1
+
+    def walk(self, rng=random):
+        first, second = BEGIN_ID, BEGIN_ID
+        words = []
+        while True:
+            i = self.row(first, second)
+            if i < 0:
+                break
+            lo, hi = self.indptr[i], self.indptr[i + 1]
+            r = rng.randrange(self.weights[hi - 1])
+            word_id = self.followers[bisect.bisect_right(self.weights, r, lo, hi)]
+            if word_id == END_ID:
+                break
+            words.append(word_id)
+            first, second = second, word_id
+        return words
+
+    def make_sentence(self, vocab, rng=random):
+        words = self.walk(rng)
+        return ' '.join(vocab[i] for i in words) if words else None
@@ -0,0 +1,29 @@
+import time
+from datetime import datetime
+
+
+class Clock:
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.fromtimestamp(self.time())
+
+
+class SimClock(Clock):
+    """
+    Simulated time moved forward by the simulator. Real time spent since the last move is added,
+    so processing delays still show up as lag.
+    """
+    def __init__(self, ts):
+        self.set(ts)
+
+    def set(self, ts):
+        self.base = ts
+        self.set_at = time.perf_counter()
+
+    def time(self):
+        return self.base + time.perf_counter() - self.set_at
+
+
+SYSTEM_CLOCK = Clock()
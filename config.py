@@ -1,5 +1,9 @@
+import asyncio
 import json
+import os
 from enum import Enum
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional
 
 
 class ConfKey(Enum):
@@ -12,11 +16,32 @@ class ConfKey(Enum):
     WORK_DELAY = 'work_delay_h'
     WORK_DURATION = 'work_duration_h'
     REMIND_INTERVAL = 'remind_interval_h'
-    BACKGROUND_DELAY = 'background_delay_s'
     MESSAGES = 'messages'
     MARKOV_CHANNELS = 'markov_channels'
     TALK_HOURS = 'talk_hours'
     USERS = 'users'
+    STATE_FLUSH_INTERVAL = 'state_flush_interval_s'
+    MARKOV_WORKERS = 'markov_workers'
+    MARKOV_BUFFER_SIZE = 'markov_buffer_size'
+    MARKOV_BUFFER_LOW = 'markov_buffer_low'
+    MARKOV_HISTORY_CONCURRENCY = 'markov_history_concurrency'
+    MARKOV_MODEL_CACHE = 'markov_model_cache'
+    MARKOV_MAX_OVERLAP = 'markov_max_overlap'
+    MARKOV_READY_TIMEOUT = 'markov_ready_timeout_s'
+    AUDIO_CACHE = 'audio_cache_mb'
+    VOICE_IDLE_TIMEOUT = 'voice_idle_timeout_s'
+    AVATAR_DEBOUNCE = 'avatar_debounce_s'
+    AVATAR_MIN_INTERVAL = 'avatar_min_interval_s'
+    SUPERVISOR_CONCURRENCY = 'supervisor_concurrency'
+    SUPERVISOR_TIMEOUT = 'supervisor_timeout_s'
+    METRICS_PORT = 'metrics_port'
+    OUTBOUND_BATCH_WINDOW = 'outbound_batch_window_s'
+    OUTBOUND_RATE_LIMIT = 'outbound_rate_limit'
+    OUTBOUND_RATE_PERIOD = 'outbound_rate_period_s'
+    EVENTS_DB = 'events_db'
+    GUILDS = 'guilds'
+    SHARD_COUNT = 'shard_count'
+    SHARD_IDS = 'shard_ids'
 
 
 class MsgKey(Enum):
@@ -31,13 +56,49 @@ class MsgKey(Enum):
     FAILURE = 'failure'
 
 
+class UserRecord(NamedTuple):
+    id: int
+    name: str
+    emoji: str
+
+
+class Lookups(NamedTuple):
+    users: Mapping[int, UserRecord]
+    ids_by_name: Mapping[str, int]
+    ids_by_emoji: Mapping[str, int]
+
+    @classmethod
+    def build(cls, conf):
+        users = {int(id_str): UserRecord(int(id_str), info['name'], info['emoji'])
+                 for id_str, info in conf.get(ConfKey.USERS.value, {}).items()}
+        return cls(MappingProxyType(users),
+                   MappingProxyType({user.name: user.id for user in users.values()}),
+                   MappingProxyType({user.emoji: user.id for user in users.values()}))
+
+
 class Config:
     def __init__(self, filename):
         self.filename = filename
         self.conf = json.load(open(filename))
+        self.lookups = Lookups.build(self.conf)
+        self.views = {}
 
-    def get(self, key: ConfKey):
-        return self.conf.get(key.value)
+    def guild_ids(self):
+        """
+        The configured guilds, empty when the config describes a single guild at the top level.
+        """
+        return [int(guild_id) for guild_id in self.conf.get(ConfKey.GUILDS.value) or {}]
+
+    def for_guild(self, guild_id):
+        if guild_id is None:
+            return self
+        view = self.views.get(guild_id)
+        if view is None:
+            view = self.views[guild_id] = GuildConfig(self, guild_id)
+        return view
+
+    def get(self, key: ConfKey, default=None):
+        return self.conf.get(key.value, default)
 
     def get_by_id(self, key):
         return self.conf.get(key)
@@ -45,13 +106,66 @@ class Config:
     def get_msg(self, key: MsgKey):
         return self.conf[ConfKey.MESSAGES.value].get(key.value)
 
+    def get_user(self, user_id) -> Optional[UserRecord]:
+        return self.lookups.users.get(user_id)
+
+    def get_users(self):
+        return list(self.lookups.users.values())
+
+    def get_user_by_name(self, name) -> Optional[UserRecord]:
+        return self.lookups.users.get(self.lookups.ids_by_name.get(name))
+
+    def get_user_by_emoji(self, emoji) -> Optional[UserRecord]:
+        return self.lookups.users.get(self.lookups.ids_by_emoji.get(emoji))
+
     def get_emoji(self, user_id):
-        res = self.conf[ConfKey.USERS.value].get(str(user_id))
-        return res['emoji'] if res else None
+        res = self.lookups.users.get(user_id)
+        return res.emoji if res else None
 
     def get_name(self, user_id):
-        res = self.conf[ConfKey.USERS.value].get(str(user_id))
-        return res['name'] if res else None
+        res = self.lookups.users.get(user_id)
+        return res.name if res else None
 
     def reload(self):
-        self.conf = json.load(open(self.filename))
+        conf = json.load(open(self.filename))
+        lookups = Lookups.build(conf)
+        # no await in between, so the event loop never sees a mix of old and new tables
+        self.conf, self.lookups = conf, lookups
+        for view in self.views.values():
+            view.refresh()
+
+    async def watch(self, interval=2.0):
+        mtime = os.stat(self.filename).st_mtime_ns
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                new_mtime = os.stat(self.filename).st_mtime_ns
+                if new_mtime != mtime:
+                    mtime = new_mtime
+                    self.reload()
+                    print(f'reloaded {self.filename}')
+            except (OSError, ValueError, KeyError) as e:
+                print(f'could not reload {self.filename}: {e}')
+
+
+class GuildConfig(Config):
+    """
+    One guild's view of the config, keys in its entry under 'guilds' override the top level ones.
+    """
+    def __init__(self, parent: Config, guild_id):
+        self.parent = parent
+        self.guild_id = guild_id
+        self.filename = parent.filename
+        self.views = {}
+        self.refresh()
+
+    def refresh(self):
+        conf = dict(self.parent.conf)
+        conf.update((conf.get(ConfKey.GUILDS.value) or {}).get(str(self.guild_id), {}))
+        self.conf, self.lookups = conf, Lookups.build(conf)
+
+    def reload(self):
+        self.parent.reload()
+
+    async def watch(self, interval=2.0):
+        await self.parent.watch(interval)
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import re
+import struct
+import zlib
+
+
+MAGIC = b'MKT1'
+# compressed size, number of records
+BLOCK = struct.Struct('<II')
+# message id, content hash, text size
+RECORD = struct.Struct('<QQI')
+URL_RE = re.compile(r'<?https?://\S+')
+# the bot's own commands, other messages starting with punctuation are ordinary chat
+COMMAND_RE = re.compile(r'!(markov|work|gg|testmsg)\b')
+MIN_WORDS = 3
+
+
+def clean(text):
+    """
+    Returns the text to train on, or None if the message should not be part of a corpus.
+    """
+    text = URL_RE.sub('', text).strip()
+    if COMMAND_RE.match(text) or len(text.split()) < MIN_WORDS:
+        return None
+    return text
+
+
+def content_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def read_blocks(filename):
+    """
+    Yields (end offset, records) for every complete block, a block cut short by a crash ends the file.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{filename} is not a corpus')
+        while True:
+            header = f.read(BLOCK.size)
+            if len(header) < BLOCK.size:
+                return
+            size, n = BLOCK.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            data = zlib.decompress(data)
+            records = []
+            pos = 0
+            for _ in range(n):
+                msg_id, h, length = RECORD.unpack_from(data, pos)
+                pos += RECORD.size
+                records.append((msg_id, h, data[pos:pos + length].decode('utf-8')))
+                pos += length
+            yield f.tell(), records
+
+
+def read_texts(filename):
+    for _, records in read_blocks(filename):
+        for _, _, text in records:
+            yield text
+
+
+class CorpusWriter:
+    """
+    Appends cleaned messages to a corpus file, skipping message ids and texts it already holds.
+    Without autoflush, full blocks are left to the owner to write with take_block and write_block,
+    which can run on another thread as long as the writes stay in order.
+    """
+    def __init__(self, filename, block_size=1000, autoflush=True):
+        self.filename = filename
+        self.block_size = block_size
+        self.autoflush = autoflush
+        self.ids = set()
+        self.hashes = set()
+        self.pending = []
+        self.end = 0
+        if os.path.exists(filename) and os.path.getsize(filename):
+            for self.end, records in read_blocks(filename):
+                for msg_id, h, _ in records:
+                    self.ids.add(msg_id)
+                    self.hashes.add(h)
+            self.end = self.end or len(MAGIC)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, msg_id, text):
+        text = clean(text)
+        if text is None or msg_id in self.ids:
+            return False
+        h = content_hash(text)
+        if h in self.hashes:
+            return False
+        self.ids.add(msg_id)
+        self.hashes.add(h)
+        self.pending.append((msg_id, h, text.encode('utf-8')))
+        if self.autoflush and self.full():
+            self.flush()
+        return True
+
+    def full(self):
+        return len(self.pending) >= self.block_size
+
+    def take_block(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def write_block(self, pending):
+        if not pending:
+            return
+        block = zlib.compress(b''.join(RECORD.pack(msg_id, h, len(data)) + data for msg_id, h, data in pending))
+        with open(self.filename, 'r+b' if self.end else 'wb') as f:
+            if not self.end:
+                f.write(MAGIC)
+                self.end = len(MAGIC)
+            # drop whatever a crashed append left behind the last complete block
+            f.seek(self.end)
+            f.truncate()
+            f.write(BLOCK.pack(len(block), len(pending)) + block)
+            f.flush()
+            os.fsync(f.fileno())
+            self.end = f.tell()
+
+    def flush(self):
+        self.write_block(self.take_block())
+
+    def close(self):
+        self.flush()
+        if not self.end:
+            # nothing was kept, an empty corpus still marks the source as converted
+            with open(self.filename, 'wb') as f:
+                f.write(MAGIC)
+            self.end = len(MAGIC)
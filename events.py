@@ -0,0 +1,59 @@
+import sqlite3
+from enum import Enum
+from clock import SYSTEM_CLOCK
+
+
+class EventKind(Enum):
+    AWAKE = 'awake'
+    START = 'start'
+    REMIND = 'remind'
+    DONE = 'done'
+    SLACKING = 'slacking'
+
+
+class EventLog:
+    def __init__(self, filename='events.db', clock=SYSTEM_CLOCK):
+        self.clock = clock
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, '
+                        'ts REAL NOT NULL, kind TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS events_user_ts ON events (user_id, ts)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS events_user_kind_ts ON events (user_id, kind, ts)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS events_ts ON events (ts)')
+        self.db.commit()
+
+    def record(self, user_id, kind: EventKind, ts=None):
+        self.db.execute('INSERT INTO events (user_id, ts, kind) VALUES (?, ?, ?)',
+                        (user_id, ts if ts is not None else self.clock.time(), kind.value))
+        self.db.commit()
+
+    def history(self, user_id, limit=10):
+        rows = self.db.execute('SELECT ts, kind FROM events WHERE user_id = ? ORDER BY ts DESC LIMIT ?', (user_id, limit))
+        return [(ts, EventKind(kind)) for ts, kind in rows]
+
+    def counts(self, since, until):
+        res = {}
+        rows = self.db.execute('SELECT user_id, kind, COUNT(*) FROM events WHERE ts >= ? AND ts < ? GROUP BY user_id, kind',
+                               (since, until))
+        for user_id, kind, n in rows:
+            res.setdefault(user_id, {})[EventKind(kind)] = n
+        return res
+
+    def work_durations(self, since, until):
+        """
+        Returns {user_id: (number of sessions, average seconds)} for work sessions started in [since, until).
+        A session is a start directly followed by a done, a start followed by another start never ended.
+        """
+        rows = self.db.execute(
+            'SELECT user_id, COUNT(*), AVG(next_ts - ts) FROM ('
+            '  SELECT user_id, kind, ts, LEAD(kind) OVER w AS next_kind, LEAD(ts) OVER w AS next_ts'
+            '  FROM events WHERE kind IN (?, ?) AND ts >= ?'
+            '  WINDOW w AS (PARTITION BY user_id ORDER BY ts)'
+            ') WHERE kind = ? AND next_kind = ? AND ts < ? GROUP BY user_id',
+            (EventKind.START.value, EventKind.DONE.value, since, EventKind.START.value, EventKind.DONE.value, until))
+        return {user_id: (n, avg) for user_id, n, avg in rows}
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,59 @@
+from contextlib import asynccontextmanager
+
+
+class FakeMember:
+    def __init__(self, id, bot=False):
+        self.id = id
+        self.bot = bot
+        self.mention = f'<@{id}>'
+        self.display_name = f'user{id}'
+
+    def mentioned_in(self, msg):
+        return self.mention in msg.content
+
+
+class FakeMessage:
+    def __init__(self, id, author, channel, content, guild=None):
+        self.id = id
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.guild = guild
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+
+class FakeChannel:
+    """
+    Stands in for a discord text or voice channel, sent messages are kept in memory.
+    """
+    def __init__(self, id, messages=(), members=()):
+        self.id = id
+        self.messages = list(messages)
+        self.members = list(members)
+        self.sent = []
+
+    async def send(self, content):
+        msg = FakeMessage(len(self.sent) + 1, None, self, content)
+        self.sent.append(msg)
+        return msg
+
+    @asynccontextmanager
+    async def typing(self):
+        yield
+
+    async def history(self, limit=None, after=None, oldest_first=False):
+        msgs = self.messages if oldest_first else self.messages[::-1]
+        for msg in msgs[:limit]:
+            if after is None or msg.id > after.id:
+                yield msg
+
+
+class FakeBot:
+    def __init__(self, channels):
+        self.channels = {channel.id: channel for channel in channels}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
@@ -3,13 +3,16 @@ from config import Config, ConfKey
 from therapy_bot import TherapyBot
 
 
-def run_bot(config):
-    disc = TherapyBot(config)
+def run_bot(config, shard_ids=None, shard_count=None):
+    disc = TherapyBot(config, shard_ids, shard_count)
     disc.run(config.get(ConfKey.DISCORD_TOKEN))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', '-c', type=str, default='config.json', help='config json')
+    parser.add_argument('--shard-ids', type=str, help='comma separated shards to run in this process, metrics are served on metrics_port plus the lowest one')
+    parser.add_argument('--shard-count', type=int, help='total number of shards across all processes')
     args = parser.parse_args()
-    run_bot(Config(args.config))
+    shard_ids = [int(i) for i in args.shard_ids.split(',')] if args.shard_ids else None
+    run_bot(Config(args.config), shard_ids, args.shard_count)
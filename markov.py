@@ -1,98 +1,545 @@
+import argparse
+import csv
+import discord
+import glob
+import hashlib
+import json
 import markovify
+import multiprocessing
 import os
 import random
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from chain import CompactChain, Vocab, VocabSnapshot, check_chain
 from config import Config, ConfKey
+from corpus import CorpusWriter, clean, read_blocks, read_texts
+from metrics import METRICS
+from overlap import OverlapIndex
 import asyncio
 
 
-FILENAME = 'markov/{}.json'
-TXT_FILE = 'markov/{}.txt'
+# every file is relative to a model directory, one per guild
+MARKOV_DIR = 'markov'
+FILENAME = '{}/{}.mkc'
+OVERLAP_FILE = '{}/{}.ovl'
+CORPUS_FILE = '{}/{}.corpus'
+# corpora written by older versions, converted on startup
+TXT_FILE = '{}/{}.txt'
+HWM_FILE = '{}/channels.json'
+VOCAB_FILE = '{}/vocab.txt'
+VOCAB_SNAPSHOT = '{}/vocab.bin'
+
+# models loaded inside a pool worker, keyed by model file, stored as (mtime, model, overlap index) in LRU order
+_worker_models = OrderedDict()
+_worker_cache_size = 8
+_worker_max_overlap = 0.7
+# vocabularies keyed by model directory, stored as (mtime, vocab)
+_worker_vocabs = {}
+
+
+def _init_worker(cache_size, max_overlap):
+    global _worker_cache_size, _worker_max_overlap
+    _worker_cache_size = cache_size
+    _worker_max_overlap = max_overlap
+
+
+def _is_pinned(fn):
+    return os.path.basename(fn) == 'all.mkc'
+
+
+def _load_model(directory, key):
+    fn = FILENAME.format(directory, key)
+    mtime = os.stat(fn).st_mtime_ns
+    cached = _worker_models.get(fn)
+    if cached is None or cached[0] != mtime:
+        # models built before overlap indexes existed generate without the check
+        ovl = OVERLAP_FILE.format(directory, key)
+        index = OverlapIndex.load(ovl) if os.path.exists(ovl) else None
+        cached = _worker_models[fn] = (mtime, CompactChain.load(fn), index)
+    _worker_models.move_to_end(fn)
+    # the 'all' models are pinned and do not count towards the cache size
+    while sum(not _is_pinned(k) for k in _worker_models) > _worker_cache_size:
+        del _worker_models[next(k for k in _worker_models if not _is_pinned(k))]
+    return cached[1], cached[2]
+
+
+def _load_vocab(directory):
+    fn = VOCAB_SNAPSHOT.format(directory)
+    mtime = os.stat(fn).st_mtime_ns
+    cached = _worker_vocabs.get(directory)
+    if cached is None or cached[0] != mtime:
+        cached = _worker_vocabs[directory] = (mtime, VocabSnapshot.load(fn))
+    return cached[1]
+
+
+def _snapshot_vocab(directory):
+    Vocab.load(VOCAB_FILE.format(directory)).save_snapshot(VOCAB_SNAPSHOT.format(directory))
+
+
+def _check_model(fn):
+    key = os.path.basename(fn)[:-len('.mkc')]
+    if key != 'all' and not key.isdigit():
+        print(f'ignoring unknown model {fn}')
+        return None
+    if not check_chain(fn):
+        print(f'ignoring invalid model {fn}')
+        return None
+    return key if key == 'all' else int(key)
+
+
+def _corpus_key(fn):
+    key = os.path.basename(fn)[:-len('.corpus')]
+    if key == 'all':
+        return key
+    return int(key) if key.isdigit() else None
+
+
+def _seed_corpus(directory, key):
+    """
+    Starts the .tmp corpus a regenerate writes with everything the current corpus holds,
+    so messages that are not in the read history any more, like imported ones, are kept.
+    """
+    tmp = CORPUS_FILE.format(directory, key) + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    writer = CorpusWriter(tmp)
+    for _, records in read_blocks(CORPUS_FILE.format(directory, key)):
+        for msg_id, _, text in records:
+            writer.add(msg_id, text)
+    writer.flush()
+    writer.autoflush = False
+    return writer
+
+
+def _migrate_txt(fn):
+    directory, key = os.path.dirname(fn), os.path.basename(fn)[:-len('.txt')]
+    with open(fn, 'r') as f:
+        lines = f.read().split('\n')
+    # old corpora have no message ids, line numbers never collide with real snowflakes
+    writer = CorpusWriter(CORPUS_FILE.format(directory, key) + '.tmp')
+    for i, line in enumerate(lines):
+        writer.add(i, line)
+    writer.close()
+    os.replace(CORPUS_FILE.format(directory, key) + '.tmp', CORPUS_FILE.format(directory, key))
+    print(f'converted {fn}, kept {len(writer)} of {len(lines)} lines')
+
+
+def _build_model(directory, key):
+    texts = list(read_texts(CORPUS_FILE.format(directory, key)))
+    if len(texts) < 20:
+        return None
+    # every message is one sentence, whatever newlines it contains
+    model = markovify.Text(None, parsed_sentences=[text.split() for text in texts], retain_original=False)
+    vocab = Vocab.load(VOCAB_FILE.format(directory))
+    if key == 'all':
+        # every author's messages are part of the 'all' corpus, so its words cover all models
+        for state, followers in model.chain.model.items():
+            for word in state + tuple(followers):
+                vocab.add(word)
+        vocab.save(VOCAB_FILE.format(directory))
+        vocab.save_snapshot(VOCAB_SNAPSHOT.format(directory))
+    # the index is written first, workers reload both when the model's mtime changes
+    OverlapIndex.build(texts, vocab).save(OVERLAP_FILE.format(directory, key))
+    CompactChain.from_markovify(model.chain, vocab).save(FILENAME.format(directory, key))
+    return key
+
+
+def _make_sentence(directory, key, tries=100):
+    model, index = _load_model(directory, key)
+    vocab = _load_vocab(directory)
+    for i in range(tries):
+        words = model.walk()
+        if words and (index is None or not index.overlaps(words, _worker_max_overlap)):
+            return ' '.join(vocab[w] for w in words), i + 1
+    return None, tries
+
+
+def _make_sentences(directory, key, n, tries=100):
+    res = []
+    attempts = 0
+    for i in range(n):
+        m, k = _make_sentence(directory, key, tries)
+        attempts += k
+        if m:
+            res.append(m)
+    return res, attempts
+
+
+def _build_batches(keys):
+    """
+    Splits model keys into batches to build one after another, the keys within a batch can be built in parallel.
+    The shared vocabulary is extended while building 'all' and only read by the others, so 'all' goes first on its own.
+    """
+    rest = [key for key in keys if key != 'all']
+    return [['all'], rest] if 'all' in keys else [rest]
+
+
+def make_pool(config: Config):
+    return ProcessPoolExecutor(max_workers=config.get(ConfKey.MARKOV_WORKERS),
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker,
+                               initargs=(config.get(ConfKey.MARKOV_MODEL_CACHE, 8),
+                                         config.get(ConfKey.MARKOV_MAX_OVERLAP, 0.7)))
+
+
+def _parse_export(fn):
+    """
+    Reads a DiscordChatExporter style JSON or CSV export, returns (message id, author id, text)
+    for every message by a human that survives corpus.clean.
+    """
+    res = []
+    if fn.endswith('.csv'):
+        with open(fn, 'r', encoding='utf-8-sig', newline='') as f:
+            for row in csv.DictReader(f):
+                text = clean(row.get('Content') or '')
+                if text is None or not row.get('AuthorID'):
+                    continue
+                msg_id = row.get('ID')
+                if not msg_id:
+                    # csv exports carry no message ids, author and timestamp identify a message just as well
+                    key = f"{row['AuthorID']}:{row.get('Date')}".encode('utf-8')
+                    msg_id = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') >> 1
+                res.append((int(msg_id), int(row['AuthorID']), text))
+        return res
+    with open(fn, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    for msg in data['messages'] if isinstance(data, dict) else data:
+        author = msg.get('author') or {}
+        if author.get('isBot', author.get('bot', False)) or 'id' not in author:
+            continue
+        text = clean(msg.get('content') or '')
+        if text is not None:
+            res.append((int(msg['id']), int(author['id']), text))
+    return res
+
+
+def import_exports(export_dir, directory=MARKOV_DIR, workers=None, config: Config = None):
+    """
+    Adds every message in the export files under export_dir to the corpora in directory and rebuilds their models.
+    Imported messages are kept by later regenerates. The worker settings come from config if one is given.
+    """
+    cache_size, max_overlap = _worker_cache_size, _worker_max_overlap
+    if config is not None:
+        cache_size = config.get(ConfKey.MARKOV_MODEL_CACHE, cache_size)
+        max_overlap = config.get(ConfKey.MARKOV_MAX_OVERLAP, max_overlap)
+    files = sorted(glob.glob(os.path.join(export_dir, '**', '*.json'), recursive=True) +
+                   glob.glob(os.path.join(export_dir, '**', '*.csv'), recursive=True))
+    os.makedirs(directory, exist_ok=True)
+    writers = {}
+    added = set()
+    n = kept = 0
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(cache_size, max_overlap)) as pool:
+        futures = {pool.submit(_parse_export, fn): fn for fn in files}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                msgs = future.result()
+            except (OSError, ValueError, KeyError) as e:
+                print(f'skipping {futures[future]}: {e}')
+                continue
+            for msg_id, author_id, text in msgs:
+                n += 1
+                for key in ('all', author_id):
+                    writer = writers.get(key)
+                    if writer is None:
+                        writer = writers[key] = CorpusWriter(CORPUS_FILE.format(directory, key))
+                    if writer.add(msg_id, text):
+                        added.add(key)
+                        kept += key == 'all'
+            elapsed = max(time.monotonic() - start, 0.001)
+            print(f'[{i + 1}/{len(files)}] {futures[future]}: {len(msgs)} messages, {n / elapsed:.0f} msg/s overall')
+        for writer in writers.values():
+            writer.close()
+        elapsed = max(time.monotonic() - start, 0.001)
+        print(f'parsed {n} messages from {len(files)} files in {elapsed:.1f}s ({n / elapsed:.0f} msg/s), {kept} new after deduplication')
+
+        start = time.monotonic()
+        built = []
+        for batch in _build_batches(added):
+            built += [future.result() for future in [pool.submit(_build_model, directory, key) for key in batch]]
+        built = [key for key in built if key is not None]
+        print(f'built {len(built)} models in {time.monotonic() - start:.1f}s')
+    return built
 
 
 class Markov:
-    def __init__(self, bot, config: Config):
+    def __init__(self, bot, config: Config, directory=MARKOV_DIR, pool=None):
         self.bot = bot
         self.config = config
-        self.models = {}
+        self.directory = directory
+        self.models = set()
+        self.loaded = asyncio.Event()
+        self.buffers = {}
+        self.refilling = {}
+        self.buffer_hits = 0
+        self.buffer_misses = 0
+        # regenerate and update write the same corpus files and positions, only one runs at a time
+        self.rebuilding = asyncio.Lock()
+        # guilds share one pool, a pool passed in is shut down by its owner
+        self.owns_pool = pool is None
+        self.pool = pool if pool is not None else make_pool(config)
 
     async def load_models(self):
-        work_channel = self.config.get(ConfKey.WORK_CHANNEL)
-        keys = ['all']
-        for member in self.bot.get_channel(work_channel).members:
-            if not member.bot:
-                keys.append(member.id)
-        for key in keys:
-            fn = FILENAME.format(key)
-            if os.path.exists(fn):
-                with open(fn, 'r') as f:
-                    self.models[key] = markovify.Text.from_json(f.read())
+        # only the model files are checked here, pool workers map them on first use
+        loop = asyncio.get_running_loop()
+        try:
+            if os.path.exists(VOCAB_FILE.format(self.directory)) and not os.path.exists(VOCAB_SNAPSHOT.format(self.directory)):
+                await loop.run_in_executor(None, _snapshot_vocab, self.directory)
+            # vocab.txt is the shared vocabulary, not an old corpus
+            legacy = [fn for fn in glob.glob(TXT_FILE.format(self.directory, '*'))
+                      if fn != VOCAB_FILE.format(self.directory)
+                      and not os.path.exists(CORPUS_FILE.format(self.directory, os.path.basename(fn)[:-len('.txt')]))]
+            results = await asyncio.gather(*[loop.run_in_executor(self.pool, _migrate_txt, fn) for fn in legacy], return_exceptions=True)
+            for fn, res in zip(legacy, results):
+                if isinstance(res, Exception):
+                    print(f'could not convert {fn}: {res!r}')
+            keys = await asyncio.gather(*[loop.run_in_executor(None, _check_model, fn)
+                                          for fn in glob.glob(FILENAME.format(self.directory, '*'))])
+            self.models.update(key for key in keys if key is not None)
+        finally:
+            # talk waits for this, whatever models did load are better than waiting for the timeout every time
+            self.loaded.set()
+        if self.has_model('all'):
+            self.refill('all')
+
+    def has_model(self, key):
+        return key in self.models
+
+    def refill(self, key):
+        if key in self.refilling:
+            return
+        buf = self.buffers.setdefault(key, deque(maxlen=self.config.get(ConfKey.MARKOV_BUFFER_SIZE, 20)))
+        if len(buf) >= self.config.get(ConfKey.MARKOV_BUFFER_LOW, 5):
+            return
+        self.refilling[key] = asyncio.get_running_loop().create_task(self.refill_task(key, buf))
+
+    async def refill_task(self, key, buf):
+        loop = asyncio.get_running_loop()
+        try:
+            while len(buf) < buf.maxlen:
+                sentences, attempts = await loop.run_in_executor(self.pool, _make_sentences, self.directory, key, buf.maxlen - len(buf))
+                METRICS.inc('markov_sentence_attempts_total', attempts)
+                METRICS.inc('markov_sentences_total', len(sentences))
+                if not sentences or self.buffers.get(key) is not buf:
+                    break
+                buf.extend(sentences)
+        finally:
+            if self.refilling.get(key) is asyncio.current_task():
+                del self.refilling[key]
+
+    def close(self):
+        for task in self.refilling.values():
+            task.cancel()
+        if self.owns_pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
 
     async def on_command(self, msg, cmd):
-        if cmd == "regenerate":
-            n = await self.regenerate(msg)
+        if cmd in ("regenerate", "regenerate keep", "update") and self.rebuilding.locked():
+            await msg.channel.send("already regenerating")
+        elif cmd == "regenerate":
+            async with self.rebuilding:
+                n = await self.regenerate(msg)
             await msg.channel.send(f"finished regenerating, using {n} messages")
         elif cmd == "regenerate keep":
-            n = await self.regenerate(msg, keep=True)
+            async with self.rebuilding:
+                n = await self.regenerate(msg, keep=True)
             await msg.channel.send(f"finished regenerating, using {n} messages")
+        elif cmd == "update":
+            async with self.rebuilding:
+                n = await self.update(msg)
+            await msg.channel.send(f"finished updating, using {n} new messages")
+        elif cmd == "stats":
+            total = self.buffer_hits + self.buffer_misses
+            rate = self.buffer_hits / total if total else 0
+            sizes = ', '.join(f'{key}: {len(buf)}' for key, buf in self.buffers.items())
+            await msg.channel.send(f"sentence buffer hits: {self.buffer_hits}, misses: {self.buffer_misses} ({rate:.0%})\n"
+                                   f"buffered: {sizes}")
         elif cmd.startswith("imitate "):
-            name = cmd[8:]
-            for id_str, info in self.config.get(ConfKey.USERS).items():
-                if info['name'] == name:
-                    await self.talk(msg.channel, user=int(id_str))
-                    break
+            user = self.config.get_user_by_name(cmd[8:])
+            if user is not None:
+                await self.talk(msg.channel, user=user.id)
+
+    def load_hwm(self):
+        if not os.path.exists(HWM_FILE.format(self.directory)):
+            return {}
+        with open(HWM_FILE.format(self.directory), 'r') as f:
+            return json.load(f)
+
+    def save_hwm(self, hwm):
+        with open(HWM_FILE.format(self.directory), 'w') as f:
+            json.dump(hwm, f)
+
+    async def build_models(self, orig_msg, keys):
+        loop = asyncio.get_running_loop()
+        results = []
+        with METRICS.timer('markov_regenerate_seconds', phase='build'):
+            for batch in _build_batches(keys):
+                results += await asyncio.gather(*[loop.run_in_executor(self.pool, _build_model, self.directory, key) for key in batch],
+                                                return_exceptions=True)
+        for res in results:
+            if isinstance(res, KeyError):
+                await orig_msg.channel.send(str(res))
+            elif isinstance(res, Exception):
+                raise res
+            elif res is not None:
+                self.models.add(res)
+                self.buffers.pop(res, None)
+                # a refill still running for the old model would keep the new buffer from being filled
+                task = self.refilling.pop(res, None)
+                if task is not None:
+                    task.cancel()
+                self.refill(res)
 
     async def regenerate(self, orig_msg, keep=False):
-        msgs = {'all': []}
-        n = 0
         if keep:
             keys = ['all']
             work_channel = self.config.get(ConfKey.WORK_CHANNEL)
             for member in self.bot.get_channel(work_channel).members:
                 if not member.bot:
                     keys.append(member.id)
-            for key in keys:
-                fn = TXT_FILE.format(key)
-                if os.path.exists(fn):
-                    with open(fn, 'r') as f:
-                        msgs[key] = f.read().split('\n')
-        else:
-            for i, channel in enumerate(self.config.get(ConfKey.MARKOV_CHANNELS)):
-                await orig_msg.channel.send(f'reading channel {i + 1}/{len(self.config.get(ConfKey.MARKOV_CHANNELS))}')
+            await self.build_models(orig_msg, [key for key in keys if os.path.exists(CORPUS_FILE.format(self.directory, key))])
+            return 0
+        loop = asyncio.get_running_loop()
+        sem = asyncio.Semaphore(self.config.get(ConfKey.MARKOV_HISTORY_CONCURRENCY, 3))
+        # compressing and syncing blocks would stall the gateway, one thread writes them in order
+        io = ThreadPoolExecutor(1)
+        writes = []
+        writers = {}
+        hwm = {}
+
+        def write(key, msg):
+            writer = writers.get(key)
+            if writer is None:
+                if os.path.exists(CORPUS_FILE.format(self.directory, key) + '.tmp'):
+                    os.remove(CORPUS_FILE.format(self.directory, key) + '.tmp')
+                writer = writers[key] = CorpusWriter(CORPUS_FILE.format(self.directory, key) + '.tmp', autoflush=False)
+            if writer.add(msg.id, msg.content) and writer.full():
+                writes.append(loop.run_in_executor(io, writer.write_block, writer.take_block()))
+
+        async def read_channel(channel):
+            async with sem:
+                start = time.monotonic()
+                # an empty channel still gets a position, messages sent after it was read have larger ids
+                started = discord.utils.time_snowflake(datetime.now(timezone.utc))
+                n = 0
                 async for msg in self.bot.get_channel(channel).history(limit=10**5):
+                    if str(channel) not in hwm:
+                        hwm[str(channel)] = msg.id
                     if not msg.author.bot:
                         n += 1
-                        text = msg.content
-                        msgs['all'].append(text)
-                        if msg.author.id not in msgs:
-                            msgs[msg.author.id] = [text]
-                        else:
-                            msgs[msg.author.id].append(text)
-        for key, texts in msgs.items():
-            if len(texts) < 20:
-                continue
-            if not keep:
-                with open(TXT_FILE.format(key), 'w') as f:
-                    f.write('\n'.join(texts))
-            try:
-                model = markovify.NewlineText('\n'.join(texts), retain_original=False)
-                self.models[key] = model.compile(inplace=True)
-                with open(FILENAME.format(key), 'w') as f:
-                    f.write(self.models[key].to_json())
-            except KeyError as e:
-                await orig_msg.channel.send(str(e))
+                        write('all', msg)
+                        write(msg.author.id, msg)
+                hwm.setdefault(str(channel), started)
+                elapsed = max(time.monotonic() - start, 0.001)
+                await orig_msg.channel.send(f'read {n} messages from <#{channel}> in {elapsed:.0f}s ({n / elapsed:.0f} msg/s)')
+                return n
+
+        try:
+            with METRICS.timer('markov_regenerate_seconds', phase='read'):
+                existing = [key for key in map(_corpus_key, glob.glob(CORPUS_FILE.format(self.directory, '*'))) if key is not None]
+                writers.update(zip(existing, await asyncio.gather(*[loop.run_in_executor(io, _seed_corpus, self.directory, key)
+                                                                    for key in existing])))
+                n = sum(await asyncio.gather(*[read_channel(channel) for channel in self.config.get(ConfKey.MARKOV_CHANNELS)]))
+                await asyncio.gather(*writes, *[loop.run_in_executor(io, writer.close) for writer in writers.values()])
+        except BaseException:
+            io.shutdown(wait=True, cancel_futures=True)
+            for key in writers:
+                if os.path.exists(CORPUS_FILE.format(self.directory, key) + '.tmp'):
+                    os.remove(CORPUS_FILE.format(self.directory, key) + '.tmp')
+            raise
+        finally:
+            io.shutdown(wait=False)
+        keys = []
+        for key, writer in writers.items():
+            if len(writer) < 20:
+                if os.path.exists(CORPUS_FILE.format(self.directory, key) + '.tmp'):
+                    os.remove(CORPUS_FILE.format(self.directory, key) + '.tmp')
+            else:
+                os.replace(CORPUS_FILE.format(self.directory, key) + '.tmp', CORPUS_FILE.format(self.directory, key))
+                keys.append(key)
+        await self.build_models(orig_msg, keys)
+        self.save_hwm(hwm)
+        return n
+
+    async def update(self, orig_msg):
+        loop = asyncio.get_running_loop()
+        hwm = self.load_hwm()
+        io = ThreadPoolExecutor(1)
+        writes = []
+        writers = {}
+        added = set()
+        n = 0
+        channels = self.config.get(ConfKey.MARKOV_CHANNELS)
+        try:
+            for i, channel in enumerate(channels):
+                after = hwm.get(str(channel))
+                if after is None:
+                    await orig_msg.channel.send(f'no previous position for channel {i + 1}/{len(channels)}, run regenerate first')
+                    continue
+                await orig_msg.channel.send(f'updating channel {i + 1}/{len(channels)}')
+                async for msg in self.bot.get_channel(channel).history(limit=None, after=discord.Object(id=after), oldest_first=True):
+                    hwm[str(channel)] = msg.id
+                    if not msg.author.bot:
+                        for key in ('all', msg.author.id):
+                            writer = writers.get(key)
+                            if writer is None:
+                                # opening reads the existing corpus to know what it already holds
+                                writer = writers[key] = await loop.run_in_executor(
+                                    io, lambda fn: CorpusWriter(fn, autoflush=False), CORPUS_FILE.format(self.directory, key))
+                            if writer.add(msg.id, msg.content):
+                                added.add(key)
+                                n += key == 'all'
+                                if writer.full():
+                                    writes.append(loop.run_in_executor(io, writer.write_block, writer.take_block()))
+            await asyncio.gather(*writes, *[loop.run_in_executor(io, writer.close) for writer in writers.values()])
+        finally:
+            io.shutdown(wait=False)
+        await self.build_models(orig_msg, list(added))
+        self.save_hwm(hwm)
         return n
 
     async def talk(self, channel, user='all', cont_chance=0.5):
-        model = self.models.get(user)
-        if model is None:
+        if not self.loaded.is_set():
+            try:
+                await asyncio.wait_for(self.loaded.wait(), self.config.get(ConfKey.MARKOV_READY_TIMEOUT, 5.0))
+            except asyncio.TimeoutError:
+                return
+        if not self.has_model(user):
             return
+        loop = asyncio.get_running_loop()
         keep_talking = True
         while keep_talking:
-            for i in range(100):
-                m = model.make_sentence()
-                if m:
-                    await channel.trigger_typing()
+            buf = self.buffers.get(user)
+            if buf:
+                m = buf.popleft()
+                self.buffer_hits += 1
+                METRICS.inc('markov_buffer_total', result='hit')
+            else:
+                with METRICS.timer('markov_make_sentence_seconds'):
+                    m, attempts = await loop.run_in_executor(self.pool, _make_sentence, self.directory, user)
+                self.buffer_misses += 1
+                METRICS.inc('markov_buffer_total', result='miss')
+                METRICS.inc('markov_sentence_attempts_total', attempts)
+                METRICS.inc('markov_sentences_total', 1 if m else 0)
+            self.refill(user)
+            if m:
+                async with channel.typing():
                     await asyncio.sleep(0.04 * len(m))
                     await channel.send(m)
-                    break
             keep_talking = random.random() < cont_chance
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Markov corpus and model maintenance.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='import JSON/CSV channel exports, !markov regenerate keeps them')
+    import_parser.add_argument('export_dir', help='directory searched recursively for .json and .csv exports')
+    import_parser.add_argument('--directory', '-d', default=MARKOV_DIR, help='model directory to add the messages to')
+    import_parser.add_argument('--workers', '-j', type=int, help='parser processes, defaults to the cpu count')
+    import_parser.add_argument('--config', '-c', help='config json to take the markov settings from')
+    args = parser.parse_args()
+    if args.command == 'import':
+        import_exports(args.export_dir, args.directory, args.workers, Config(args.config) if args.config else None)
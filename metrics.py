@@ -0,0 +1,132 @@
+import asyncio
+import functools
+import logging
+import time
+from aiohttp import web
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+def label_str(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        # both keyed by (name, sorted label items)
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    with self.timer(name, **labels):
+                        return await func(*args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    with self.timer(name, **labels):
+                        return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f'# TYPE {name} counter')
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f'{name}{label_str(labels)} {value}')
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (n, labels), hist in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                total = 0
+                for le, count in zip([*hist.buckets, '+Inf'], hist.counts):
+                    total += count
+                    lines.append(f'{name}_bucket{label_str(labels + (("le", le),))} {total}')
+                lines.append(f'{name}_sum{label_str(labels)} {hist.sum}')
+                lines.append(f'{name}_count{label_str(labels)} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        lines = []
+        for (name, labels), hist in sorted(self.histograms.items()):
+            avg = hist.sum / hist.count * 1000 if hist.count else 0
+            lines.append(f'{name}{label_str(labels)}: {hist.count} × {avg:0.2f}ms')
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f'{name}{label_str(labels)}: {value}')
+        return lines
+
+    async def serve(self, host, port):
+        async def handle(request):
+            return web.Response(text=self.render(), content_type='text/plain', charset='utf-8')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError:
+            await runner.cleanup()
+            raise
+        return runner
+
+
+class RateLimitHandler(logging.Handler):
+    def __init__(self, metrics: Metrics):
+        super().__init__(logging.WARNING)
+        self.metrics = metrics
+
+    def emit(self, record):
+        if not isinstance(record.msg, str):
+            return
+        # a global 429 logs both messages, the global one is counted on its own
+        if record.msg.startswith('We are being rate limited'):
+            self.metrics.inc('discord_rate_limit_hits_total')
+        elif record.msg.startswith('Global rate limit'):
+            self.metrics.inc('discord_global_rate_limit_hits_total')
+
+
+METRICS = Metrics()
@@ -0,0 +1,93 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+from metrics import METRICS
+
+
+CHECK_MARK = '\N{WHITE HEAVY CHECK MARK}'
+CROSS_MARK = '\N{CROSS MARK}'
+MAX_LENGTH = 2000
+
+
+def split_message(lines, limit=MAX_LENGTH):
+    """
+    Joins lines into as few messages of at most limit characters as possible, overlong lines are cut.
+    """
+    res = []
+    for line in lines:
+        line = line[:limit]
+        if res and len(res[-1]) + 1 + len(line) <= limit:
+            res[-1] += '\n' + line
+        else:
+            res.append(line)
+    return res
+
+
+async def add_prompt_reactions(msg):
+    await asyncio.gather(msg.add_reaction(CHECK_MARK), msg.add_reaction(CROSS_MARK))
+
+
+class Dispatcher:
+    def __init__(self, window=1.0, rate=5, period=5.0):
+        self.window = window
+        self.rate = rate
+        self.period = period
+        # per channel id: queued (text, prompt, future), running flush task and recent send times
+        self.pending = {}
+        self.flushers = {}
+        self.sent = {}
+
+    def queue(self, channel, text, prompt=False):
+        """
+        Queues text for channel, lines queued within the batch window are sent as one message.
+        Returns a future for the message the text ended up in.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(channel.id, []).append((text, prompt, fut))
+        if channel.id not in self.flushers:
+            self.flushers[channel.id] = asyncio.get_running_loop().create_task(self.flush(channel))
+        return fut
+
+    async def pace(self, channel_id):
+        sent = self.sent.setdefault(channel_id, deque(maxlen=self.rate))
+        if len(sent) == self.rate and time.monotonic() - sent[0] < self.period:
+            METRICS.inc('outbound_paced_total')
+            await asyncio.sleep(self.period - (time.monotonic() - sent[0]))
+        sent.append(time.monotonic())
+
+    async def flush(self, channel):
+        try:
+            await asyncio.sleep(self.window)
+            while self.pending.get(channel.id):
+                queued = self.pending.pop(channel.id)
+                while queued:
+                    batch = [queued.pop(0)]
+                    length = len(batch[0][0])
+                    while queued and length + 1 + len(queued[0][0]) <= MAX_LENGTH:
+                        length += 1 + len(queued[0][0])
+                        batch.append(queued.pop(0))
+                    try:
+                        await self.pace(channel.id)
+                        msg = await channel.send('\n'.join(text for text, _, _ in batch))
+                    except Exception as e:
+                        # nobody awaits the flusher, the failure is logged here and the rest of the queue still goes out
+                        METRICS.inc('outbound_failures_total')
+                        print(f'sending {len(batch)} queued line(s) to {channel.id} failed:')
+                        traceback.print_exc()
+                        for _, _, fut in batch:
+                            if not fut.done():
+                                fut.set_exception(e)
+                        continue
+                    METRICS.observe('outbound_batch_size', len(batch))
+                    if any(prompt for _, prompt, _ in batch):
+                        try:
+                            await add_prompt_reactions(msg)
+                        except Exception:
+                            print(f'adding prompt reactions in {channel.id} failed:')
+                            traceback.print_exc()
+                    for _, _, fut in batch:
+                        if not fut.done():
+                            fut.set_result(msg)
+        finally:
+            del self.flushers[channel.id]
@@ -0,0 +1,106 @@
+import math
+import mmap
+import os
+import re
+import struct
+
+
+MASK = (1 << 64) - 1
+BASE = 0x100000001b3
+SENTENCE_SEED = 0x9e3779b97f4a7c15
+MAGIC = b'MKO1'
+# magic, number of bits, number of probes, shingle size
+HEADER = struct.Struct('<4sQII')
+
+
+def mix(h):
+    # splitmix64 finalizer
+    h = (h ^ (h >> 30)) * 0xbf58476d1ce4e5b9 & MASK
+    h = (h ^ (h >> 27)) * 0x94d049bb133111eb & MASK
+    return h ^ (h >> 31)
+
+
+def shingle_hashes(ids, n):
+    """
+    Rolling polynomial hashes of every n consecutive word ids.
+    """
+    top = pow(BASE, n - 1, 1 << 64)
+    h = 0
+    for i, word_id in enumerate(ids):
+        if i >= n:
+            h = (h - (ids[i - n] + 1) * top) & MASK
+        h = (h * BASE + word_id + 1) & MASK
+        if i >= n - 1:
+            yield h
+
+
+def sentence_hash(ids):
+    h = 0
+    for word_id in ids:
+        h = (h * BASE + word_id + 1) & MASK
+    return h ^ SENTENCE_SEED
+
+
+def tokenize(line, vocab):
+    # same word split as markovify, words the chain never saw get an id no generated sentence can have
+    return [vocab.ids.get(word, MASK) for word in re.split(r'\s+', line.strip())]
+
+
+class OverlapIndex:
+    """
+    Bloom filter of the word n-gram shingles and whole sentences of a corpus.
+    """
+    def __init__(self, bits, n_bits, k, n):
+        self.bits = bits
+        self.n_bits = n_bits
+        self.k = k
+        self.n = n
+
+    @classmethod
+    def build(cls, lines, vocab, n=4, fp_rate=0.01):
+        sentences = [tokenize(line, vocab) for line in lines if line.strip()]
+        n_items = max(sum(max(len(ids) - n + 1, 0) + 1 for ids in sentences), 1)
+        n_bits = max(int(-n_items * math.log(fp_rate) / math.log(2) ** 2), 64)
+        n_bits = (n_bits + 7) // 8 * 8
+        k = max(round(n_bits / n_items * math.log(2)), 1)
+        index = cls(bytearray(n_bits // 8), n_bits, k, n)
+        for ids in sentences:
+            index.add(sentence_hash(ids))
+            for h in shingle_hashes(ids, n):
+                index.add(h)
+        return index
+
+    def positions(self, h):
+        h1 = mix(h)
+        h2 = mix(h1) | 1
+        return ((h1 + i * h2) % self.n_bits for i in range(self.k))
+
+    def add(self, h):
+        for pos in self.positions(h):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, h):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(h))
+
+    def overlaps(self, ids, max_ratio=0.7):
+        if sentence_hash(ids) in self:
+            return True
+        hashes = list(shingle_hashes(ids, self.n))
+        if not hashes:
+            return False
+        return sum(h in self for h in hashes) >= max_ratio * len(hashes)
+
+    def save(self, filename):
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(HEADER.pack(MAGIC, self.n_bits, self.k, self.n))
+            f.write(self.bits)
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        magic, n_bits, k, n = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError(f'{filename} is not an overlap index')
+        return cls(buf[HEADER.size:], n_bits, k, n)
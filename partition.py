@@ -0,0 +1,41 @@
+import os
+from audio import Announcer, ClipLibrary
+from config import Config, ConfKey
+from events import EventLog
+from markov import Markov
+from scheduler import Scheduler
+from state import State
+from supervisor import Supervisor
+
+
+class Partition:
+    """
+    Everything the bot keeps for one guild. The partition for guild id None is the single guild
+    layout, its files stay in the working directory.
+    """
+    def __init__(self, bot, config: Config, guild_id, clips: ClipLibrary, pool=None):
+        self.guild_id = guild_id
+        self.directory = '.' if guild_id is None else os.path.join('guilds', str(guild_id))
+        os.makedirs(os.path.join(self.directory, 'markov'), exist_ok=True)
+        self.config = config.for_guild(guild_id)
+        self.state = State(self.config, os.path.join(self.directory, 'state.json'), bot.clock)
+        self.scheduler = Scheduler(self.state)
+        # a busy guild only uses up its own action slots
+        self.supervisor = Supervisor(self.config.get(ConfKey.SUPERVISOR_CONCURRENCY, 4),
+                                     self.config.get(ConfKey.SUPERVISOR_TIMEOUT, 120.0), bot.clock)
+        self.events = EventLog(os.path.join(self.directory, self.config.get(ConfKey.EVENTS_DB, 'events.db')), bot.clock)
+        self.markov = Markov(bot, self.config, os.path.join(self.directory, 'markov'), pool)
+        self.announcer = Announcer(bot, clips, self.config.get(ConfKey.VOICE_IDLE_TIMEOUT, 60.0))
+        self.prev_talk = 0
+        self.guessing_prompt = None
+        self.guessing_target = None
+        self.guesses = []
+        self.guessing_blocked = False
+        self.tasks = []
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.state.close()
+        self.events.close()
+        self.markov.close()
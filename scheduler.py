@@ -0,0 +1,81 @@
+import asyncio
+import heapq
+from enum import Enum
+from state import State, UserState, UserKey
+
+
+class Action(Enum):
+    START = 'start'
+    STOP = 'stop'
+    REMIND = 'remind'
+
+
+def next_deadline(user: UserState):
+    if not user.get(UserKey.ENABLED):
+        return None
+    deadlines = []
+    if user.get(UserKey.AWAKE) > user.get(UserKey.WORKING):
+        deadlines.append(user.get(UserKey.AWAKE) + user.get(UserKey.WORK_DELAY) * 3600)
+    if not user.get(UserKey.DONE):
+        deadlines.append(user.get(UserKey.WORKING) + user.get(UserKey.WORK_DURATION) * 3600)
+        deadlines.append(user.get(UserKey.REMIND) + user.get(UserKey.REMIND_INTERVAL) * 3600)
+    return min(deadlines) if deadlines else None
+
+
+def due_action(user: UserState, ts):
+    if not user.get(UserKey.ENABLED):
+        return None
+    if user.get(UserKey.AWAKE) > user.get(UserKey.WORKING) and (ts - user.get(UserKey.AWAKE)) >= user.get(UserKey.WORK_DELAY) * 3600:
+        return Action.START
+    elif not user.get(UserKey.DONE) and (ts - user.get(UserKey.WORKING)) >= user.get(UserKey.WORK_DURATION) * 3600:
+        return Action.STOP
+    elif not user.get(UserKey.DONE) and (ts - user.get(UserKey.REMIND)) >= user.get(UserKey.REMIND_INTERVAL) * 3600:
+        return Action.REMIND
+    return None
+
+
+class Scheduler:
+    def __init__(self, state: State):
+        self.state = state
+        self.heap = []
+        self.deadlines = {}
+        self.wakeup = asyncio.Event()
+        state.listeners.append(self.reschedule)
+
+    def reschedule(self, user_id):
+        user = self.state.get_user(user_id)
+        deadline = next_deadline(user) if user else None
+        if deadline == self.deadlines.get(user_id):
+            return
+        if deadline is None:
+            del self.deadlines[user_id]
+            return
+        earliest = self.next_deadline()
+        self.deadlines[user_id] = deadline
+        heapq.heappush(self.heap, (deadline, user_id))
+        if earliest is None or deadline < earliest:
+            self.wakeup.set()
+
+    def reschedule_all(self):
+        for user_id in list(self.state.user_cache):
+            self.reschedule(user_id)
+
+    def next_deadline(self):
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, ts):
+        due = []
+        while (deadline := self.next_deadline()) is not None and deadline <= ts:
+            _, user_id = heapq.heappop(self.heap)
+            del self.deadlines[user_id]
+            due.append((deadline, user_id))
+        return due
+
+    async def wait(self, timeout):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
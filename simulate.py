@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from collections import deque
+from datetime import datetime
+from clock import SimClock
+from config import Config, ConfKey
+from events import EventKind
+from fakes import FakeChannel, FakeMember, FakeMessage
+from metrics import METRICS
+from state import UserKey
+from therapy_bot import TherapyBot
+
+
+class SimBot(TherapyBot):
+    """
+    TherapyBot with discord replaced by in-memory channels and members, driven by a SimClock.
+    """
+    def __init__(self, config: Config, clock: SimClock, members):
+        super().__init__(config, clock=clock)
+        self.me = FakeMember(0, bot=True)
+        self.members = {member.id: member for member in members}
+        self.channels = {}
+        for key in (ConfKey.MAIN_CHANNEL, ConfKey.WORK_CHANNEL, ConfKey.VOICE_CHANNEL):
+            self.channels.setdefault(config.get(key), FakeChannel(config.get(key)))
+        # lateness of every action, not just the most recent ones
+        for partition in self.partitions.values():
+            partition.supervisor.lateness = deque()
+
+    @property
+    def user(self):
+        return self.me
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_user(self, user_id):
+        return self.members.get(user_id)
+
+    async def fetch_user(self, user_id):
+        return self.members[user_id]
+
+    async def drain(self):
+        chains = [task for partition in self.partitions.values() for task in partition.supervisor.chains.values()]
+        while chains or self.dispatcher.flushers:
+            await asyncio.gather(*chains, *self.dispatcher.flushers.values(), return_exceptions=True)
+            chains = [task for partition in self.partitions.values() for task in partition.supervisor.chains.values()]
+
+    def close_partitions(self):
+        for partition in self.partitions.values():
+            partition.close()
+        self.markov_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def synthetic_trace(user_ids, start, days, interval, rng):
+    """
+    (ts, user id) for every message: each user wakes around their own hour, stays up for 14 to 17 hours
+    and writes a message every interval seconds on average.
+    """
+    trace = []
+    for user_id in user_ids:
+        wake_hour = rng.gauss(9, 2)
+        for day in range(days):
+            t = start + day * 86400 + (wake_hour + rng.gauss(0, 1)) * 3600
+            sleep = t + rng.uniform(14, 17) * 3600
+            while t < sleep:
+                trace.append((t, user_id))
+                t += rng.expovariate(1 / interval)
+    trace.sort()
+    return trace
+
+
+def load_trace(filename):
+    trace = []
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                ts, user_id = line.strip().split(',')[:2]
+                trace.append((float(ts), int(user_id)))
+            except ValueError:
+                continue
+    trace.sort()
+    return trace
+
+
+async def simulate(bot: SimBot, trace, start, end, flush_interval):
+    p = bot.partitions[None]
+    main = bot.get_channel(bot.config.get(ConfKey.MAIN_CHANNEL))
+    p.scheduler.reschedule_all()
+    i = 0
+    flushes = 0
+    t = start
+    next_flush = start + flush_interval
+    while t < end:
+        bot.clock.set(t)
+        while i < len(trace) and trace[i][0] <= t:
+            await bot.on_message(FakeMessage(i + 1, bot.members[trace[i][1]], main, 'hi'))
+            i += 1
+        bot.background_pass(p)
+        await bot.drain()
+        if t >= next_flush:
+            if p.state.dirty:
+                flushes += 1
+            p.state.flush()
+            next_flush += flush_interval
+        wake = [end, next_flush]
+        if i < len(trace):
+            wake.append(trace[i][0])
+        if p.scheduler.next_deadline() is not None:
+            wake.append(p.scheduler.next_deadline())
+        t = max(min(wake), t + 0.001)
+    return flushes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays user activity against the bot in simulated time.')
+    parser.add_argument('--config', '-c', default='config_example.json', help='config json, channels and timings are taken from it')
+    parser.add_argument('--users', type=int, default=500, help='number of synthetic users')
+    parser.add_argument('--days', type=int, default=7, help='simulated days of synthetic activity')
+    parser.add_argument('--interval', type=float, default=1800, help='average seconds between a user\'s messages')
+    parser.add_argument('--trace', help='csv of recorded "ts,user_id" messages to replay instead')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the JSON report to')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        conf = json.load(f)
+    # talking needs markov models, and the simulation should not wait on outbound pacing
+    conf[ConfKey.TALK_HOURS.value] = []
+    conf[ConfKey.OUTBOUND_BATCH_WINDOW.value] = 0
+    conf[ConfKey.OUTBOUND_RATE_LIMIT.value] = 10**9
+    conf.pop(ConfKey.GUILDS.value, None)
+    res_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'res'))
+
+    if args.trace:
+        trace = load_trace(args.trace)
+        start, end = trace[0][0], trace[-1][0] + 3600
+    else:
+        start = datetime(2024, 1, 1).timestamp()
+        end = start + args.days * 86400
+        trace = synthetic_trace(range(1, args.users + 1), start, args.days, args.interval, random.Random(args.seed))
+    user_ids = sorted({user_id for _, user_id in trace})
+
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='therapy_sim_')
+    try:
+        # state, events and avatar images are relative to the working directory
+        os.chdir(directory)
+        os.symlink(res_dir, 'res')
+        with open('config.json', 'w') as f:
+            json.dump(conf, f)
+        config = Config('config.json')
+
+        async def run():
+            bot = SimBot(config, SimClock(start), [FakeMember(user_id) for user_id in user_ids])
+            try:
+                p = bot.partitions[None]
+                for user_id in user_ids:
+                    # done, so nobody starts with a session that ended in 1970
+                    p.state.set_user_key(user_id, UserKey.ENABLED, True)
+                    p.state.set_user_key(user_id, UserKey.DONE, True)
+                wall, cpu = time.perf_counter(), time.process_time()
+                flushes = await simulate(bot, trace, start, end, config.get(ConfKey.STATE_FLUSH_INTERVAL, 30.0))
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+                counts = {kind: 0 for kind in EventKind}
+                for kinds in p.events.counts(start, end + 1).values():
+                    for kind, n in kinds.items():
+                        counts[kind] += n
+                return bot, flushes, wall, cpu, counts
+            finally:
+                bot.close_partitions()
+
+        bot, flushes, wall, cpu, counts = asyncio.run(run())
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+    hours = (end - start) / 3600
+    lateness = sorted(late for p in bot.partitions.values() for _, late in p.supervisor.lateness)
+    written = METRICS.counters.get(('state_write_bytes_total', ()), 0)
+    report = {
+        'users': len(user_ids),
+        'messages': len(trace),
+        'simulated_hours': hours,
+        'wall_seconds': wall,
+        'speedup': hours * 3600 / wall,
+        'events': {kind.value: n for kind, n in counts.items()},
+        'actions': len(lateness),
+        'lag_mean_seconds': statistics.fmean(lateness) if lateness else 0,
+        'lag_p95_seconds': lateness[int(len(lateness) * 0.95)] if lateness else 0,
+        'lag_max_seconds': lateness[-1] if lateness else 0,
+        'state_flushes': flushes,
+        'state_write_bytes': written,
+        'state_write_bytes_per_hour': written / hours,
+        'cpu_seconds_per_hour': cpu / hours,
+    }
+    print(f'simulated {hours:.0f}h for {len(user_ids)} users in {wall:.1f}s ({report["speedup"]:.0f}x real time)')
+    print('events: ' + ', '.join(f'{kind}: {n}' for kind, n in report['events'].items()))
+    print(f'action lag: mean {report["lag_mean_seconds"] * 1000:.1f}ms, p95 {report["lag_p95_seconds"] * 1000:.1f}ms, '
+          f'max {report["lag_max_seconds"] * 1000:.1f}ms over {len(lateness)} actions')
+    print(f'state: {flushes} flushes, {written / 2**20:.1f}MB written ({report["state_write_bytes_per_hour"] / 2**10:.0f}KB/h)')
+    print(f'cpu: {report["cpu_seconds_per_hour"] * 1000:.1f}ms per simulated hour')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
-from tinydb import TinyDB, Query
-from tinydb.operations import delete
-import time
+from tinydb import TinyDB
+from tinydb.storages import Storage
+from tinydb.middlewares import CachingMiddleware
+import asyncio
+import json
+import os
+import tempfile
 from enum import Enum
+from clock import SYSTEM_CLOCK
 from config import ConfKey
+from metrics import METRICS
 
 
 class UserKey(Enum):
@@ -41,16 +47,63 @@ class UserState:
         return r if r is not None else default
 
 
+class AtomicJSONStorage(Storage):
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as f:
+            data = f.read()
+        return json.loads(data) if data else None
+
+    def write(self, data):
+        data = json.dumps(data)
+        METRICS.inc('state_write_bytes_total', len(data))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def close(self):
+        pass
+
+
 class State:
-    def __init__(self, config):
+    def __init__(self, config, filename='state.json', clock=SYSTEM_CLOCK):
         self.config = config
-        self.db = TinyDB('state.json')
+        self.clock = clock
+        self.db = TinyDB(filename, storage=CachingMiddleware(AtomicJSONStorage))
         self.users = self.db.table('users')
-        self.events = self.db.table('events')
+        self.user_cache = {user[UserKey.ID.value]: dict(user) for user in self.users.all()}
+        self.dirty = False
+        self.listeners = []
+        # number of enabled users that are slacking / not done, kept up to date by set_user_key
+        self.slacking_count = 0
+        self.not_done_count = 0
+        for user in self.user_cache.values():
+            self.count_flags(user, 1)
+
+    def count_flags(self, user, sign):
+        if user.get(UserKey.ENABLED.value):
+            if user.get(UserKey.SLACKING.value):
+                self.slacking_count += sign
+            if not user.get(UserKey.DONE.value):
+                self.not_done_count += sign
+
+    def changed(self, user_id):
+        for listener in self.listeners:
+            listener(user_id)
 
     def get_user_key(self, user_id, key: UserKey, default=0):
-        user = Query()
-        res = self.users.get(user.id == user_id)
+        res = self.user_cache.get(user_id)
         if res:
             val = res.get(key.value)
             if val is None:
@@ -60,37 +113,70 @@ class State:
             return self.config.get_by_id(key.value) if key in user_conf else default
 
     def set_user_key(self, user_id, key: UserKey, val):
-        user = Query()
+        res = self.user_cache.get(user_id)
+        if res is None:
+            res = self.user_cache[user_id] = {UserKey.ID.value: user_id}
+        self.count_flags(res, -1)
         if val is not None:
-            self.users.upsert({key.value: val}, user.id == user_id)
+            res[key.value] = val
         else:
-            self.users.upsert(delete(key.value), user.id == user_id)
+            res.pop(key.value, None)
+        self.count_flags(res, 1)
+        self.dirty = True
+        self.changed(user_id)
+
+    def with_defaults(self, user):
+        user = dict(user)
+        for key in user_conf:
+            if key.value not in user:
+                user[key.value] = self.config.get_by_id(key.value)
+        return UserState(user)
+
+    def get_user(self, user_id):
+        user = self.user_cache.get(user_id)
+        return self.with_defaults(user) if user else None
 
     def get_enabled_users(self):
-        user = Query()
-        for user in self.users.search(user.enabled == True):
-            for key in user_conf:
-                if key.value not in user:
-                    user[key.value] = self.config.get_by_id(key.value)
-            yield UserState(user)
+        for user in self.user_cache.values():
+            if user.get(UserKey.ENABLED.value) == True:
+                yield self.with_defaults(user)
 
     def update_last_active(self, user_id):
         awoken = False
-        user = Query()
-        user_info = self.users.get(user.id == user_id)
-        res = UserState(user_info)
-        ts = time.time()
+        user_info = self.user_cache.get(user_id)
+        ts = self.clock.time()
         if user_info:
+            res = UserState(user_info)
             awake_cooldown = res.get(UserKey.AWAKE_COOLDOWN, self.config.get(ConfKey.AWAKE_COOLDOWN)) * 3600
             sleep_min = res.get(UserKey.SLEEP_MIN, self.config.get(ConfKey.SLEEP_MIN)) * 3600
             if (ts - res.get(UserKey.AWAKE)) > awake_cooldown and (ts - res.get(UserKey.LAST_ACTIVE)) > sleep_min:
                 res.set(UserKey.AWAKE, ts)
                 awoken = res.get(UserKey.ENABLED)
             res.set(UserKey.LAST_ACTIVE, ts)
-            self.users.upsert(res.state, user.id == user_id)
         else:
+            res = UserState()
             res.set(UserKey.LAST_ACTIVE, ts)
             res.set(UserKey.AWAKE, ts)
             res.set(UserKey.ID, user_id)
-            self.users.insert(res.state)
+            self.user_cache[user_id] = res.state
+        self.dirty = True
+        self.changed(user_id)
         return awoken
+
+    @METRICS.timed('state_op_seconds', op='flush')
+    def flush(self):
+        if not self.dirty:
+            return
+        self.users.truncate()
+        self.users.insert_multiple(self.user_cache.values())
+        self.db.storage.flush()
+        self.dirty = False
+
+    async def flush_task(self):
+        while True:
+            await asyncio.sleep(self.config.get(ConfKey.STATE_FLUSH_INTERVAL, 30.0))
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self.db.close()
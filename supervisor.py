@@ -0,0 +1,43 @@
+import asyncio
+import traceback
+from collections import deque
+from clock import SYSTEM_CLOCK
+from metrics import METRICS
+
+
+class Supervisor:
+    def __init__(self, concurrency=4, timeout=120.0, clock=SYSTEM_CLOCK):
+        self.clock = clock
+        self.sem = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        # last task submitted per key, later tasks for the same key wait for it
+        self.chains = {}
+        # (name, seconds between deadline and start) of recent deadline-driven actions
+        self.lateness = deque(maxlen=1000)
+
+    def submit(self, key, name, coro_fn, *args, deadline=None):
+        prev = self.chains.get(key)
+        task = asyncio.get_running_loop().create_task(self.run(prev, key, name, coro_fn, args, deadline))
+        self.chains[key] = task
+        task.add_done_callback(lambda t: self.chains.pop(key) if self.chains.get(key) is t else None)
+        return task
+
+    async def run(self, prev, key, name, coro_fn, args, deadline):
+        if prev is not None:
+            await asyncio.wait([prev])
+        async with self.sem:
+            if deadline is not None:
+                late = self.clock.time() - deadline
+                self.lateness.append((name, late))
+                METRICS.observe('action_lateness_seconds', late, action=name)
+                if late > 5:
+                    print(f'{name} for {key} started {late:0.1f}s after its deadline')
+            try:
+                await asyncio.wait_for(coro_fn(*args), self.timeout)
+            except asyncio.TimeoutError:
+                METRICS.inc('action_failures_total', action=name, reason='timeout')
+                print(f'{name} for {key} timed out after {self.timeout}s')
+            except Exception:
+                METRICS.inc('action_failures_total', action=name, reason='error')
+                print(f'{name} for {key} failed:')
+                traceback.print_exc()
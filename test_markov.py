@@ -0,0 +1,45 @@
+import asyncio
+import os
+import random
+from benchmarks import make_config, synthetic_messages
+from fakes import FakeBot, FakeChannel, FakeMessage
+import markov
+
+
+def test_models_load_after_regenerate(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'markov')
+    os.makedirs(directory)
+    # an old corpus without a single line long enough to keep
+    with open(markov.TXT_FILE.format(directory, 1234), 'w') as f:
+        f.write('hi\nok\n')
+    channel = FakeChannel(1)
+    channel.messages = synthetic_messages(channel, 500, 3, random.Random(0))
+    reply = FakeChannel(2)
+    bot = FakeBot([channel, reply])
+    config = make_config(str(tmp_path), [channel.id])
+
+    async def run():
+        m = markov.Markov(bot, config, directory)
+        try:
+            await m.regenerate(FakeMessage(1, None, reply, '!markov regenerate'))
+        finally:
+            m.close()
+        # a restart finds the models the regenerate built, next to vocab.txt and the old corpus
+        m = markov.Markov(bot, config, directory)
+        try:
+            await m.load_models()
+            sent = len(reply.sent)
+            await m.talk(reply, cont_chance=0)
+            assert len(reply.sent) == sent + 1
+            return m.models
+        finally:
+            m.close()
+
+    sleep = asyncio.sleep
+    # talk waits to look like typing, which only slows the test down
+    monkeypatch.setattr(asyncio, 'sleep', lambda delay, *args: sleep(0, *args))
+    models = asyncio.run(run())
+    assert os.path.exists(markov.VOCAB_FILE.format(directory))
+    assert 'all' in models
+    assert {1000, 1001, 1002} <= models
+    assert os.path.exists(markov.CORPUS_FILE.format(directory, 1234))
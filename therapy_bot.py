@@ -1,319 +1,463 @@
 import discord
 import asyncio
+import logging
+import traceback
 from enum import Enum
-from state import State, UserKey, user_conf
-from markov import Markov
+from state import UserKey, user_conf
+from scheduler import Action, due_action
+from metrics import METRICS, RateLimitHandler
+from outbound import Dispatcher, add_prompt_reactions, split_message
+from events import EventKind
+from markov import make_pool
+from audio import ClipLibrary
+from partition import Partition
 from config import Config, ConfKey, MsgKey
+from clock import SYSTEM_CLOCK
 import time
-from datetime import datetime
-from queue import Queue
+from datetime import datetime, timedelta
 import random
-import os
 
 
-class TherapyBot(discord.Client):
-    def __init__(self, config: Config):
+class TherapyBot(discord.AutoShardedClient):
+    def __init__(self, config: Config, shard_ids=None, shard_count=None, clock=SYSTEM_CLOCK):
         intents = discord.Intents.default()
         intents.message_content = True
-        super().__init__(intents=intents)
+        super().__init__(intents=intents,
+                         shard_ids=shard_ids or config.get(ConfKey.SHARD_IDS),
+                         shard_count=shard_count or config.get(ConfKey.SHARD_COUNT))
         self.config = config
-        self.state = State(config)
-        self.markov = Markov(self, config)
-        self.prev_talk = 0
+        self.clock = clock
+        self.dispatcher = Dispatcher(config.get(ConfKey.OUTBOUND_BATCH_WINDOW, 1.0),
+                                     config.get(ConfKey.OUTBOUND_RATE_LIMIT, 5),
+                                     config.get(ConfKey.OUTBOUND_RATE_PERIOD, 5.0))
+        self.markov_pool = make_pool(config)
+        self.clips = ClipLibrary('res', config.get(ConfKey.AUDIO_CACHE, 64) * 2**20)
+        self.partitions = {}
+        if not config.guild_ids():
+            self.add_partition(None)
+        self.tasks = []
         self.expression = None # todo: actual avatar
-        self.avatar_backoff = 0
+        self.wanted_expression = None
+        self.avatar_changed = asyncio.Event()
+        self.avatar_images = {}
+        for expression in Expression:
+            self.avatar_images[expression] = []
+            for img in expression.value:
+                with open(f'res/{img}.png', 'rb') as f:
+                    self.avatar_images[expression].append(f.read())
         self.angered = 0
-        self.guessing_prompt = None
-        self.guessing_target = None
-        self.guesses = []
-        self.guessing_blocked = False
-        self.audio_queue = Queue()
+        self.started = time.monotonic()
+        self.metrics_runner = None
+        self.count_api_requests()
+        logging.getLogger('discord.http').addHandler(RateLimitHandler(METRICS))
+
+    def add_partition(self, guild_id):
+        partition = self.partitions.get(guild_id)
+        if partition is None:
+            partition = self.partitions[guild_id] = Partition(self, self.config, guild_id, self.clips, self.markov_pool)
+            partition.state.listeners.append(lambda user_id: self.set_avatar())
+        return partition
+
+    def start_partition(self, partition: Partition):
+        if partition.tasks:
+            return
+        partition.tasks = [self.loop.create_task(self.load_markov(partition)),
+                           self.loop.create_task(partition.state.flush_task()),
+                           self.loop.create_task(self.background_task(partition))]
+
+    def partition(self, guild):
+        # a single guild config serves every guild the bot is in
+        if None in self.partitions:
+            return self.partitions[None]
+        return self.partitions.get(guild.id) if guild is not None else None
 
     async def on_ready(self):
-        print('I\'m in.')
-        await self.markov.load_models()
-        # await self.markov.talk(self.get_channel(self.config.get(ConfKey.MAIN_CHANNEL)))
-        self.loop.create_task(self.background_task())
+        print(f'I\'m in. ({time.monotonic() - self.started:.2f}s after start)')
+        # with sharding, only the guilds of this process' shards are opened
+        for guild in self.guilds:
+            if guild.id in self.config.guild_ids():
+                self.add_partition(guild.id)
+        for partition in self.partitions.values():
+            self.start_partition(partition)
+        if not self.tasks:
+            self.tasks = [self.loop.create_task(self.preload_clips()),
+                          self.loop.create_task(self.config.watch()),
+                          self.loop.create_task(self.avatar_task())]
+        if self.metrics_runner is None and self.config.get(ConfKey.METRICS_PORT):
+            # processes running other shards of the same config each get the port after the previous one's
+            port = self.config.get(ConfKey.METRICS_PORT) + (min(self.shard_ids) if self.shard_ids else 0)
+            try:
+                self.metrics_runner = await METRICS.serve('127.0.0.1', port)
+            except OSError as e:
+                print(f'cannot serve metrics on port {port}: {e}')
+
+    def count_api_requests(self):
+        request = self.http.request
+
+        async def counted_request(route, *args, **kwargs):
+            METRICS.inc('discord_api_requests_total', method=route.method, route=route.path)
+            return await request(route, *args, **kwargs)
+        self.http.request = counted_request
+
+    async def on_guild_join(self, guild):
+        if guild.id in self.config.guild_ids():
+            self.start_partition(self.add_partition(guild.id))
+
+    async def on_guild_available(self, guild):
+        # guilds that were unavailable when the bot became ready show up here
+        await self.on_guild_join(guild)
+
+    async def close(self):
+        for partition in self.partitions.values():
+            partition.close()
+        self.markov_pool.shutdown(wait=False, cancel_futures=True)
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+            self.metrics_runner = None
+        await super().close()
 
-    async def background_task(self):
+    async def load_markov(self, p: Partition):
+        await p.markov.load_models()
+        print(f'markov models for {p.directory} ready {time.monotonic() - self.started:.2f}s after start')
+
+    async def preload_clips(self):
+        try:
+            await self.loop.run_in_executor(None, self.clips.preload)
+        except Exception:
+            # announcements still decode their clips on demand
+            print('preloading audio clips failed:')
+            traceback.print_exc()
+        else:
+            print(f'audio clips ready {time.monotonic() - self.started:.2f}s after start')
+
+    async def background_task(self, p: Partition):
+        p.scheduler.reschedule_all()
         while True:
-            for user in self.state.get_enabled_users():
-                ts = time.time()
-                work_delay = user.get(UserKey.WORK_DELAY) * 3600
-                work_duration = user.get(UserKey.WORK_DURATION) * 3600
-                reminder_interval = user.get(UserKey.REMIND_INTERVAL) * 3600
-                user_id = user.get(UserKey.ID)
-                discord_user = self.get_user(user_id) or await self.fetch_user(user_id)
-                if user.get(UserKey.AWAKE) > user.get(UserKey.WORKING) and (ts - user.get(UserKey.AWAKE)) > work_delay:
-                    await self.user_start_working(discord_user)
-                elif not user.get(UserKey.DONE) and (ts - user.get(UserKey.WORKING)) > work_duration:
-                    await self.user_stop_working(discord_user)
-                elif not user.get(UserKey.DONE) and (ts - user.get(UserKey.REMIND)) > reminder_interval:
-                    await self.user_remind_working(discord_user)
-            ts = time.time()
-            if ts - self.prev_talk > 360 and datetime.now().hour in self.config.get(ConfKey.TALK_HOURS) and datetime.now().minute < 5:
-                await self.markov.talk(self.get_channel(self.config.get(ConfKey.MAIN_CHANNEL)))
-                self.prev_talk = ts
-            await self.set_avatar()
-            await asyncio.sleep(self.config.get(ConfKey.BACKGROUND_DELAY))
+            wake = self.background_pass(p)
+            await p.scheduler.wait(wake - self.clock.time())
+
+    def background_pass(self, p: Partition):
+        """
+        Starts the actions that are due and returns when the next pass should run.
+        """
+        with METRICS.timer('background_pass_seconds'):
+            ts = self.clock.time()
+            for deadline, user_id in p.scheduler.pop_due(ts):
+                user = p.state.get_user(user_id)
+                action = due_action(user, ts) if user else None
+                if action is not None:
+                    p.supervisor.submit(user_id, action.value, self.run_action, p, user_id, action, deadline=deadline)
+                else:
+                    p.scheduler.reschedule(user_id)
+            ts = self.clock.time()
+            if ts - p.prev_talk > 360 and self.clock.now().hour in p.config.get(ConfKey.TALK_HOURS) and self.clock.now().minute < 5:
+                p.supervisor.submit('talk', 'talk', p.markov.talk, self.get_channel(p.config.get(ConfKey.MAIN_CHANNEL)))
+                p.prev_talk = ts
+            self.set_avatar()
+        ts = self.clock.time()
+        wake = [self.next_talk_time(p, ts)]
+        if p.scheduler.next_deadline() is not None:
+            wake.append(p.scheduler.next_deadline())
+        if self.angered > ts:
+            wake.append(self.angered)
+        return min(wake)
 
+    async def run_action(self, p: Partition, user_id, action):
+        try:
+            # the user's state may have changed while this action was waiting for its turn
+            user = p.state.get_user(user_id)
+            if user is None or due_action(user, self.clock.time()) != action:
+                return
+            discord_user = self.get_user(user_id) or await self.fetch_user(user_id)
+            if action == Action.START:
+                await self.user_start_working(p, discord_user)
+            elif action == Action.STOP:
+                await self.user_stop_working(p, discord_user)
+            elif action == Action.REMIND:
+                await self.user_remind_working(p, discord_user)
+        finally:
+            p.scheduler.reschedule(user_id)
+
+    def next_talk_time(self, p: Partition, ts):
+        hour = datetime.fromtimestamp(ts).replace(minute=0, second=0, microsecond=0)
+        for i in range(25):
+            start = hour + timedelta(hours=i)
+            if start.hour not in p.config.get(ConfKey.TALK_HOURS):
+                continue
+            t = max(start.timestamp(), p.prev_talk + 361, ts)
+            if t < start.timestamp() + 300:
+                return t
+        return ts + 3600
+
+    @METRICS.timed('event_seconds', event='message')
     async def on_message(self, msg):
         if self.user.id == msg.author.id:
             return
-        if self.state.update_last_active(msg.author.id):
-            await self.user_awake(msg.author, msg.channel)
+        p = self.partition(msg.guild)
+        if p is None:
+            return
+        if p.state.update_last_active(msg.author.id):
+            await self.user_awake(p, msg.author, msg.channel)
         if msg.content.startswith("!markov"):
             cmd = msg.content[7:].strip()
-            await self.markov.on_command(msg, cmd)
+            await p.markov.on_command(msg, cmd)
         if self.user.mentioned_in(msg):
-            await self.markov.talk(msg.channel)
+            await p.markov.talk(msg.channel)
         elif msg.content == "!gg":
-            if not self.guessing_blocked:
-                await self.start_guessing_game(msg.channel)
+            if not p.guessing_blocked:
+                await self.start_guessing_game(p, msg.channel)
         elif msg.content.startswith("!testmsg "):
             _, msg_id, usr_name = msg.content.split(' ')
             msg_key = MsgKey(msg_id)
-            usr_id = 0
-            for id_str, info in self.config.get(ConfKey.USERS).items():
-                if info['name'] == usr_name:
-                    usr_id = int(id_str)
-                    break
-            else:
+            usr = p.config.get_user_by_name(usr_name)
+            if usr is None:
                 await msg.channel.send('I don\'t know who that is')
+                return
+            usr_id = usr.id
             name_first = msg_key in [MsgKey.FAILURE, MsgKey.DONE_TIMER, MsgKey.REMIND]
             delay = 3 if msg_key == MsgKey.FAILURE else (1 if msg_key in [MsgKey.DONE_TIMER, MsgKey.REMIND] else 0)
-            await self.play_message_snd(msg_key, usr_id, name_first, delay)
+            await self.play_message_snd(p, msg_key, usr_id, name_first, delay)
         elif msg.content.startswith("!work"):
             cmd = msg.content[5:].strip()
             if cmd == "awake":
-                self.state.set_user_key(msg.author.id, UserKey.AWAKE, time.time())
-                await self.user_awake(msg.author, msg.channel)
+                p.state.set_user_key(msg.author.id, UserKey.AWAKE, self.clock.time())
+                await self.user_awake(p, msg.author, msg.channel)
             elif cmd == "start":
-                await self.user_start_working(msg.author, MsgKey.WORKING_CMD, msg.channel)
+                await self.user_start_working(p, msg.author, MsgKey.WORKING_CMD, msg.channel)
             elif cmd == "done":
-                await self.user_stop_working(msg.author, MsgKey.DONE_CMD, msg.channel, False)
+                await self.user_stop_working(p, msg.author, MsgKey.DONE_CMD, msg.channel, False)
             elif cmd == "enable":
-                self.state.set_user_key(msg.author.id, UserKey.ENABLED, True)
-                await msg.channel.send(self.config.get_msg(MsgKey.ENABLE).format(msg.author.mention))
+                p.state.set_user_key(msg.author.id, UserKey.ENABLED, True)
+                await msg.channel.send(p.config.get_msg(MsgKey.ENABLE).format(msg.author.mention))
             elif cmd == "disable":
-                self.state.set_user_key(msg.author.id, UserKey.ENABLED, False)
-                await msg.channel.send(self.config.get_msg(MsgKey.DISABLE).format(msg.author.mention))
+                p.state.set_user_key(msg.author.id, UserKey.ENABLED, False)
+                await msg.channel.send(p.config.get_msg(MsgKey.DISABLE).format(msg.author.mention))
             elif cmd.startswith("set"):
                 err_msg = f'{msg.author.mention} invalid config key, valid keys are: ' + ', '.join([e.value for e in user_conf])
                 try:
                     _, key, value = cmd.split(' ')
                     key: UserKey = UserKey(key)
                     if value.lower() == 'none':
-                        self.state.set_user_key(msg.author.id, key.value, None)
+                        p.state.set_user_key(msg.author.id, key.value, None)
                         await msg.channel.send(f'{msg.author.mention} ok, unset {key.value}')
                         return
                     try:
                         value = float(value)
-                        self.state.set_user_key(msg.author.id, key, value)
+                        p.state.set_user_key(msg.author.id, key, value)
                         await msg.channel.send(f'{msg.author.mention} ok, set {key.value} to {value}')
                     except ValueError:
                         await msg.channel.send(f'{msg.author.mention} that\'s not a number!')
                 except ValueError:
                     await msg.channel.send(err_msg)
             elif cmd == "info":
-                current = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                last_active = datetime.fromtimestamp(self.state.get_user_key(msg.author.id, UserKey.LAST_ACTIVE)).strftime("%Y-%m-%d %H:%M:%S")
-                awake = datetime.fromtimestamp(self.state.get_user_key(msg.author.id, UserKey.AWAKE)).strftime("%Y-%m-%d %H:%M:%S")
-                working = datetime.fromtimestamp(self.state.get_user_key(msg.author.id, UserKey.WORKING)).strftime("%Y-%m-%d %H:%M:%S")
+                current = self.clock.now().strftime("%Y-%m-%d %H:%M:%S")
+                last_active = datetime.fromtimestamp(p.state.get_user_key(msg.author.id, UserKey.LAST_ACTIVE)).strftime("%Y-%m-%d %H:%M:%S")
+                awake = datetime.fromtimestamp(p.state.get_user_key(msg.author.id, UserKey.AWAKE)).strftime("%Y-%m-%d %H:%M:%S")
+                working = datetime.fromtimestamp(p.state.get_user_key(msg.author.id, UserKey.WORKING)).strftime("%Y-%m-%d %H:%M:%S")
                 res = [
                     f"{msg.author.mention} at {current}:",
-                    f"\tenabled: {self.state.get_user_key(msg.author.id, UserKey.ENABLED)}",
+                    f"\tenabled: {p.state.get_user_key(msg.author.id, UserKey.ENABLED)}",
                     f"\tlast active: {last_active}",
                     f"\tawake: {awake}",
                     f"\tworking: {working}",
-                    f"\tdone: {self.state.get_user_key(msg.author.id, UserKey.DONE)}",
+                    f"\tdone: {p.state.get_user_key(msg.author.id, UserKey.DONE)}",
                     f"\tconfig:"
                 ]
                 for key in user_conf:
-                    res.append(f"\t\t{key.value}: {self.state.get_user_key(msg.author.id, key)}")
+                    res.append(f"\t\t{key.value}: {p.state.get_user_key(msg.author.id, key)}")
                 await msg.channel.send('\n'.join(res))
+            elif cmd == "history":
+                res = [f"{msg.author.mention} recent events:"]
+                for ts, kind in p.events.history(msg.author.id):
+                    res.append(f"\t{datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')}: {kind.value}")
+                await msg.channel.send('\n'.join(res))
+            elif cmd == "report":
+                now = self.clock.now()
+                since = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+                counts = p.events.counts(since.timestamp(), now.timestamp())
+                durations = p.events.work_durations(since.timestamp(), now.timestamp())
+                res = [f"report since {since.strftime('%Y-%m-%d')}:"]
+                for user_id, kinds in counts.items():
+                    name = p.config.get_name(user_id) or f'<@{user_id}>'
+                    sessions, avg = durations.get(user_id, (0, None))
+                    avg_str = f'{avg / 3600:0.1f}h' if avg is not None else '-'
+                    kinds_str = ', '.join(f'{kind.value}: {kinds.get(kind, 0)}' for kind in EventKind)
+                    res.append(f"\t{name}: {sessions} sessions, average {avg_str} ({kinds_str})")
+                for text in split_message(res):
+                    await msg.channel.send(text)
+            elif cmd == "stats":
+                res = METRICS.summary()
+                await msg.channel.send('```\n' + ('\n'.join(res) or 'no data yet')[:1900] + '\n```')
 
+    @METRICS.timed('event_seconds', event='reaction_add')
     async def on_reaction_add(self, reaction, user):
         if user.id == self.user.id:
             return
         msg = reaction.message
-        prompt = self.state.get_user_key(user.id, UserKey.PROMPT)
-        done = self.state.get_user_key(user.id, UserKey.DONE)
+        p = self.partition(msg.guild)
+        if p is None:
+            return
+        prompt = p.state.get_user_key(user.id, UserKey.PROMPT)
+        done = p.state.get_user_key(user.id, UserKey.DONE)
         if prompt:
-            self.state.set_user_key(user.id, UserKey.PROMPT, 0)
+            p.state.set_user_key(user.id, UserKey.PROMPT, 0)
         if prompt == msg.id:
             if reaction.emoji == '\N{WHITE HEAVY CHECK MARK}':
                 await msg.add_reaction('<:dreamwuwu:643219778806218773>')
-                await self.set_avatar()
+                self.set_avatar()
                 if done:
-                    await msg.channel.send(self.config.get_msg(MsgKey.DONE_CMD).format(user.mention))
+                    await msg.channel.send(p.config.get_msg(MsgKey.DONE_CMD).format(user.mention))
                 else:
-                    self.state.set_user_key(user.id, UserKey.SLACKING, False)
+                    p.state.set_user_key(user.id, UserKey.SLACKING, False)
             elif reaction.emoji == '\N{CROSS MARK}':
                 await msg.add_reaction('<:angry_bird:664757860089200650>')
                 if done:
-                    await self.set_avatar(Expression.ANGRY)
-                    await msg.channel.send(self.config.get_msg(MsgKey.FAILURE).format(user.mention))
-                    await self.play_message_snd(MsgKey.FAILURE, user.id, True, 3)
-                    self.angered = time.time() + 7200
+                    self.angered = self.clock.time() + 7200
+                    self.set_avatar()
+                    await msg.channel.send(p.config.get_msg(MsgKey.FAILURE).format(user.mention))
+                    await self.play_message_snd(p, MsgKey.FAILURE, user.id, True, 3)
+                else:
+                    p.state.set_user_key(user.id, UserKey.SLACKING, True)
+                    p.events.record(user.id, EventKind.SLACKING)
+        elif p.guessing_prompt == msg.id:
+            guessed = p.config.get_user_by_emoji(str(reaction.emoji))
+            if user.id not in p.guesses and guessed is not None:
+                if p.guessing_target == guessed.id:
+                    p.guessing_prompt = None
+                    p.guessing_blocked = False
+                    discord_user = self.get_user(p.guessing_target) or await self.fetch_user(p.guessing_target)
+                    await msg.channel.send(f'{user.mention} won the guessing game by guessing {discord_user.display_name}')
                 else:
-                    self.state.set_user_key(user.id, UserKey.SLACKING, True)
-                    await self.set_avatar(Expression.THREATENING)
-        elif self.guessing_prompt == msg.id:
-            if user.id not in self.guesses:
-                for uid_str, info in self.config.get(ConfKey.USERS).items():
-                    if str(reaction.emoji) == info['emoji']:
-                        if self.guessing_target == int(uid_str):
-                            self.guessing_prompt = None
-                            self.guessing_blocked = False
-                            discord_user = self.get_user(self.guessing_target) or await self.fetch_user(self.guessing_target)
-                            await msg.channel.send(f'{user.mention} won the guessing game by guessing {discord_user.display_name}')
-                        else:
-                            self.guesses.append(user.id)
-                            await msg.channel.send(f'{user.mention} guessed wrong')
-                        break
+                    p.guesses.append(user.id)
+                    await msg.channel.send(f'{user.mention} guessed wrong')
+
+    async def send_status(self, p: Partition, channel, text, prompt=False, on_sent=None):
+        """
+        Messages sent by timers go to the work channel and are batched, replies to commands are sent right away.
+        on_sent is called with the message once it is sent.
+        """
+        if channel is None:
+            # timer actions don't wait for the batch, so they don't hold a supervisor slot through the window
+            fut = self.dispatcher.queue(self.get_channel(p.config.get(ConfKey.WORK_CHANNEL)), text, prompt)
+            fut.add_done_callback(lambda f: self.status_sent(f, on_sent))
+            return
+        msg = await channel.send(text)
+        if prompt:
+            await add_prompt_reactions(msg)
+        if on_sent is not None:
+            on_sent(msg)
 
-    async def user_awake(self, user, channel=None):
-        ch = channel or self.get_channel(self.config.get(ConfKey.WORK_CHANNEL))
-        msg = self.config.get_msg(MsgKey.AWAKE)
-        work_delay_h = self.state.get_user_key(user.id, UserKey.WORK_DELAY)
-        await ch.send(msg.format(user.mention, work_delay_h))
-        await self.play_message_snd(MsgKey.AWAKE, user.id)
+    def status_sent(self, fut, on_sent):
+        # failed sends are logged by the dispatcher
+        if not fut.cancelled() and fut.exception() is None and on_sent is not None:
+            on_sent(fut.result())
 
-    async def user_start_working(self, user, message=MsgKey.WORKING_TIMER, channel=None):
-        ch = channel or self.get_channel(self.config.get(ConfKey.WORK_CHANNEL))
-        ts = time.time()
-        self.state.set_user_key(user.id, UserKey.WORKING, ts)
-        self.state.set_user_key(user.id, UserKey.REMIND, ts)
-        self.state.set_user_key(user.id, UserKey.DONE, False)
-        await self.set_avatar()
-        await ch.send(self.config.get_msg(message).format(user.mention))
-        await self.play_message_snd(message, user.id)
+    async def user_awake(self, p: Partition, user, channel=None):
+        msg = p.config.get_msg(MsgKey.AWAKE)
+        work_delay_h = p.state.get_user_key(user.id, UserKey.WORK_DELAY)
+        p.events.record(user.id, EventKind.AWAKE)
+        await self.send_status(p, channel, msg.format(user.mention, work_delay_h))
+        await self.play_message_snd(p, MsgKey.AWAKE, user.id)
 
-    async def user_stop_working(self, user, message=MsgKey.DONE_TIMER, channel=None, prompt=True):
-        ch = channel or self.get_channel(self.config.get(ConfKey.WORK_CHANNEL))
-        self.state.set_user_key(user.id, UserKey.DONE, True)
-        self.state.set_user_key(user.id, UserKey.SLACKING, False)
-        await self.set_avatar()
-        msg = await ch.send(self.config.get_msg(message).format(user.mention))
-        if prompt:
-            await msg.add_reaction('\N{WHITE HEAVY CHECK MARK}')
-            await msg.add_reaction('\N{CROSS MARK}')
-            self.state.set_user_key(user.id, UserKey.PROMPT, msg.id)
-        else:
-            self.state.set_user_key(user.id, UserKey.PROMPT, 0)
-        await self.play_message_snd(message, user.id, message == MsgKey.DONE_TIMER, 1 if (message == MsgKey.DONE_TIMER) else 0)
+    async def user_start_working(self, p: Partition, user, message=MsgKey.WORKING_TIMER, channel=None):
+        ts = self.clock.time()
+        p.state.set_user_key(user.id, UserKey.WORKING, ts)
+        p.state.set_user_key(user.id, UserKey.REMIND, ts)
+        p.state.set_user_key(user.id, UserKey.DONE, False)
+        p.events.record(user.id, EventKind.START, ts)
+        await self.send_status(p, channel, p.config.get_msg(message).format(user.mention))
+        await self.play_message_snd(p, message, user.id)
+
+    async def user_stop_working(self, p: Partition, user, message=MsgKey.DONE_TIMER, channel=None, prompt=True):
+        p.state.set_user_key(user.id, UserKey.DONE, True)
+        p.state.set_user_key(user.id, UserKey.SLACKING, False)
+        p.events.record(user.id, EventKind.DONE)
+        p.state.set_user_key(user.id, UserKey.PROMPT, 0)
+        await self.send_status(p, channel, p.config.get_msg(message).format(user.mention), prompt,
+                               (lambda msg: p.state.set_user_key(user.id, UserKey.PROMPT, msg.id)) if prompt else None)
+        await self.play_message_snd(p, message, user.id, message == MsgKey.DONE_TIMER, 1 if (message == MsgKey.DONE_TIMER) else 0)
 
-    async def user_remind_working(self, user):
-        ch = self.get_channel(self.config.get(ConfKey.WORK_CHANNEL))
-        msg = await ch.send(self.config.get_msg(MsgKey.REMIND).format(user.mention))
-        await msg.add_reaction('\N{WHITE HEAVY CHECK MARK}')
-        await msg.add_reaction('\N{CROSS MARK}')
-        self.state.set_user_key(user.id, UserKey.PROMPT, msg.id)
-        self.state.set_user_key(user.id, UserKey.REMIND, time.time())
-        await self.play_message_snd(MsgKey.REMIND, user.id, True, 1)
+    async def user_remind_working(self, p: Partition, user):
+        p.events.record(user.id, EventKind.REMIND)
+        p.state.set_user_key(user.id, UserKey.REMIND, self.clock.time())
+        await self.send_status(p, None, p.config.get_msg(MsgKey.REMIND).format(user.mention), True,
+                               lambda msg: p.state.set_user_key(user.id, UserKey.PROMPT, msg.id))
+        await self.play_message_snd(p, MsgKey.REMIND, user.id, True, 1)
 
-    async def start_guessing_game(self, channel=None):
+    async def start_guessing_game(self, p: Partition, channel=None):
         if channel is None:
-            channel = self.get_channel(self.config.get(ConfKey.MAIN_CHANNEL))
-        users = self.config.get(ConfKey.USERS)
-        uid_str = random.choice(list(users.keys()))
-        self.guessing_target = int(uid_str)
-        self.guesses = []
+            channel = self.get_channel(p.config.get(ConfKey.MAIN_CHANNEL))
+        users = p.config.get_users()
+        p.guessing_target = random.choice(users).id
+        p.guesses = []
         msg = await channel.send("Starting guessing game!")
-        self.guessing_prompt = msg.id
-        self.guessing_blocked = True
-        infos = list(users.values())
-        random.shuffle(infos)
-        for info in infos:
-            await msg.add_reaction(info['emoji'])
+        p.guessing_prompt = msg.id
+        p.guessing_blocked = True
+        random.shuffle(users)
+        for info in users:
+            await msg.add_reaction(info.emoji)
         for i in range(5):
             await asyncio.sleep(20)
-            if self.guessing_prompt is None:
+            if p.guessing_prompt is None:
                 break
-            await self.markov.talk(channel, user=self.guessing_target, cont_chance=0)
+            await p.markov.talk(channel, user=p.guessing_target, cont_chance=0)
         else:
-            self.guessing_blocked = False
+            p.guessing_blocked = False
 
-    async def set_avatar(self, expression=None):
-        ts = time.time()
-        if ts < self.avatar_backoff:
-            print(f'waiting {self.avatar_backoff - ts:0.2f} seconds before trying again')
-            return
-        if time.time() < self.angered:
+    def set_avatar(self, expression=None):
+        if self.clock.time() < self.angered:
             expression = Expression.ANGRY
         elif expression is None:
-            expression = Expression.HAPPY
-            for user in self.state.get_enabled_users():
-                if user.get(UserKey.SLACKING):
-                    expression = Expression.THREATENING
-                elif not user.get(UserKey.DONE) and expression != Expression.THREATENING:
-                    expression = Expression.WORRIED
-        if expression != self.expression:
+            if any(p.state.slacking_count for p in self.partitions.values()):
+                expression = Expression.THREATENING
+            elif any(p.state.not_done_count for p in self.partitions.values()):
+                expression = Expression.WORRIED
+            else:
+                expression = Expression.HAPPY
+        if expression != self.wanted_expression:
+            self.wanted_expression = expression
+            self.avatar_changed.set()
+
+    async def avatar_task(self):
+        next_edit = 0
+        while True:
+            await self.avatar_changed.wait()
+            # coalesce bursts of changes and stay within the avatar rate limit
+            await asyncio.sleep(max(self.config.get(ConfKey.AVATAR_DEBOUNCE, 10.0), next_edit - self.clock.time()))
+            self.avatar_changed.clear()
+            expression = self.wanted_expression
+            if expression == self.expression:
+                continue
             if self.expression is not None:
                 print(f'yes, avatar should change from {self.expression.name} to {expression.name}')
             else:
                 print(f'yes, avatar should change to {expression.name}')
-            self.expression = expression
-            img = f'res/{random.choice(expression.value)}.png'
-            with open(img, 'rb') as f:
-                dat = f.read()
+            next_edit = self.clock.time() + self.config.get(ConfKey.AVATAR_MIN_INTERVAL, 300.0)
             try:
-                await self.user.edit(avatar=dat)
-                await asyncio.sleep(2)
+                await self.user.edit(avatar=random.choice(self.avatar_images[expression]))
+                self.expression = expression
             except discord.HTTPException:
                 print("Cannot set avatar yet")
-                self.expression = None
-                self.avatar_backoff = time.time() + 600
+                self.avatar_changed.set()
 
-    async def play_message_snd(self, msg: MsgKey, usr_id=None, name_first=False, delay=0):
-        usr_name = self.config.get_name(usr_id)
-        ch = self.get_channel(self.config.get(ConfKey.VOICE_CHANNEL))
+    async def play_message_snd(self, p: Partition, msg: MsgKey, usr_id=None, name_first=False, delay=0):
+        usr_name = p.config.get_name(usr_id)
+        ch = self.get_channel(p.config.get(ConfKey.VOICE_CHANNEL))
         for member in ch.members:
             if member.id == usr_id:
                 break
         else:
             return
-        msg_opts = []
-        i = 0
-        while os.path.exists(f'res/{msg.value}_{i}.wav'):
-            msg_opts.append(f'res/{msg.value}_{i}.wav')
-            i += 1
-        init = self.audio_queue.empty()
-        if not name_first:
-            self.audio_queue.put(random.choice(msg_opts))
-            if usr_name is not None:
-                if delay:
-                    self.audio_queue.put(delay)
-                self.audio_queue.put(f'res/{usr_name}.wav')
-        else:
-            if usr_name is not None:
-                self.audio_queue.put(f'res/{usr_name}.wav')
-                if delay:
-                    self.audio_queue.put(delay)
-            self.audio_queue.put(random.choice(msg_opts))
-        self.audio_queue.put(1)
-        if init:
-            for old_vc in self.voice_clients:
-                old_vc: discord.VoiceClient
-                if old_vc.is_connected():
-                    vc = old_vc
-                    break
-            else:
-                vc = await ch.connect()
-
-            def on_complete(err):
-                if not self.audio_queue.empty():
-                    e = self.audio_queue.get()
-                    if type(e) == int:
-                        time.sleep(e)
-                        on_complete(None)
-                    else:
-                        vc.play(discord.FFmpegPCMAudio(e), after=on_complete)
-                else:
-                    asyncio.run_coroutine_threadsafe(vc.disconnect(), vc.loop)
-            await asyncio.sleep(1)
-            vc.play(discord.FFmpegPCMAudio(self.audio_queue.get()), after=on_complete)
+        msg_clip = self.clips.message_clip(msg.value)
+        if msg_clip is None:
+            # not every message has a recording
+            return
+        name_clip = self.clips.name_clip(usr_name)
+        parts = [msg_clip]
+        if name_clip is not None:
+            parts = [name_clip, delay, msg_clip] if name_first else [msg_clip, delay, name_clip]
+        parts.append(1)
+        p.announcer.announce(ch, parts)
 
 
 class Expression(Enum):